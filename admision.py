@@ -0,0 +1,175 @@
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+# Control de admision delante de la base. Todas las escrituras terminan en el unico
+# escritor de SQLite, asi que se limita cuantas corren a la vez y cuantas esperan; si
+# la cola esta llena o la espera se pasa de ADMISION_ESPERA se contesta 503 enseguida
+# en lugar de dejar que el request venza por el lock. Ademas cada cliente (IP) tiene
+# un bucket de tokens para lecturas y otro para escrituras; sin tokens es un 429
+ADMISION_ACTIVA = os.getenv("ADMISION", "1") == "1"
+
+# Escrituras que corren a la vez y cuantas mas pueden esperar su turno
+ESCRITURAS_CONCURRENTES = int(os.getenv("ADMISION_ESCRITURAS", "4"))
+COLA_ESCRITURAS = int(os.getenv("ADMISION_COLA", "32"))
+# Segundos que una escritura espera en la cola antes del 503
+ESPERA_MAXIMA = float(os.getenv("ADMISION_ESPERA", "2"))
+
+# Requests por segundo de cada cliente y rafaga (tamaño del bucket). 0 apaga el limite
+LECTURAS_POR_SEG = float(os.getenv("LIMITE_LECTURAS_POR_SEG", "50"))
+RAFAGA_LECTURAS = float(os.getenv("LIMITE_LECTURAS_RAFAGA", "100"))
+ESCRITURAS_POR_SEG = float(os.getenv("LIMITE_ESCRITURAS_POR_SEG", "10"))
+RAFAGA_ESCRITURAS = float(os.getenv("LIMITE_ESCRITURAS_RAFAGA", "20"))
+# Clientes que se recuerdan; el que hace mas que no aparece pierde su bucket (vuelve lleno)
+MAX_CLIENTES = int(os.getenv("LIMITE_MAX_CLIENTES", "10000"))
+
+# Header del que sale la identidad del cliente para los limites, ej: x-forwarded-for
+# (detras de un balanceador propio) o x-api-key. Vacio usa la IP de la conexion, que
+# detras de un proxy es la del proxy salvo que uvicorn corra con --proxy-headers
+HEADER_CLIENTE = os.getenv("ADMISION_HEADER_CLIENTE", "").strip().lower().encode("latin-1")
+
+METODOS_ESCRITURA = ("POST", "PUT", "PATCH", "DELETE")
+
+# Rutas que no pasan por el control (el scrapeo de metricas tiene que andar con carga)
+RUTAS_EXENTAS = ("/metrics",)
+
+# Buckets de tokens por cliente: cada uno se llena a `tasa` tokens por segundo hasta
+# `rafaga`, y cada request gasta uno
+class BucketsPorCliente:
+
+    def __init__(self, tasa: float, rafaga: float, max_clientes: int = MAX_CLIENTES):
+        self.tasa = tasa
+        self.rafaga = max(rafaga, 1.0)
+        self.max_clientes = max_clientes
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict() # cliente -> [tokens, ultima recarga]
+
+    # Devuelve 0 si el request pasa, o los segundos hasta que haya un token
+    def tomar(self, cliente: str) -> float:
+        if self.tasa <= 0:
+            return 0.0
+        ahora = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(cliente)
+            if bucket is None:
+                bucket = self._buckets[cliente] = [self.rafaga, ahora]
+                while len(self._buckets) > self.max_clientes:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(cliente)
+                bucket[0] = min(self.rafaga, bucket[0] + (ahora - bucket[1]) * self.tasa)
+                bucket[1] = ahora
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.tasa
+
+async def _rechazar(send, status: int, detalle: str, reintentar: float):
+    body = json.dumps({"detail": detalle}).encode()
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+        (b"retry-after", str(max(1, math.ceil(reintentar))).encode()),
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+#De X-Forwarded-For se usa la ultima direccion, la que agrego el balanceador; las
+#anteriores las manda el cliente y las puede inventar. Sin el header, la IP de la conexion.
+#Tambien separa las Idempotency-Key de cada cliente (ver idempotencia.py)
+def cliente_de(scope) -> str:
+    if HEADER_CLIENTE:
+        for nombre, valor in scope["headers"]:
+            if nombre == HEADER_CLIENTE:
+                valor = valor.decode("latin-1").split(",")[-1].strip()
+                if valor:
+                    return valor
+    cliente = scope.get("client")
+    return cliente[0] if cliente else "-"
+
+# Estado del control: buckets de cada cliente, escrituras en curso y en cola, y rechazos
+class ControlAdmision:
+
+    def __init__(self):
+        self.lecturas = BucketsPorCliente(LECTURAS_POR_SEG, RAFAGA_LECTURAS)
+        self.escrituras = BucketsPorCliente(ESCRITURAS_POR_SEG, RAFAGA_ESCRITURAS)
+        self._semaforo = None # se crea en el event loop que atiende los requests
+        self.en_curso = 0
+        self.esperando = 0
+        self.rechazos = defaultdict(int) # motivo -> cantidad
+
+    # Espera un lugar para escribir. Devuelve False si la cola esta llena o se paso la espera
+    async def entrar(self) -> bool:
+        if self._semaforo is None:
+            self._semaforo = asyncio.Semaphore(ESCRITURAS_CONCURRENTES)
+        if self._semaforo.locked():
+            if self.esperando >= COLA_ESCRITURAS:
+                self.rechazos["cola_llena"] += 1
+                return False
+            self.esperando += 1
+            try:
+                await asyncio.wait_for(self._semaforo.acquire(), ESPERA_MAXIMA)
+            except asyncio.TimeoutError:
+                self.rechazos["espera_vencida"] += 1
+                return False
+            finally:
+                self.esperando -= 1
+        else:
+            await self._semaforo.acquire()
+        self.en_curso += 1
+        return True
+
+    def salir(self):
+        self.en_curso -= 1
+        self._semaforo.release()
+
+    # Estado en formato Prometheus, se agrega a /metrics
+    def exportar(self) -> str:
+        lineas = [
+            "# HELP admision_rechazos_total Requests rechazados por el control de admision.",
+            "# TYPE admision_rechazos_total counter",
+        ]
+        lineas += ['admision_rechazos_total{{motivo="{}"}} {}'.format(motivo, cantidad) for motivo, cantidad in sorted(self.rechazos.items())]
+        lineas += [
+            "# HELP admision_escrituras_en_curso Escrituras que se estan ejecutando.",
+            "# TYPE admision_escrituras_en_curso gauge",
+            "admision_escrituras_en_curso {}".format(self.en_curso),
+            "# HELP admision_escrituras_esperando Escrituras esperando en la cola.",
+            "# TYPE admision_escrituras_esperando gauge",
+            "admision_escrituras_esperando {}".format(self.esperando),
+        ]
+        return "\n".join(lineas) + "\n"
+
+control_admision = ControlAdmision()
+
+class AdmisionMiddleware:
+
+    def __init__(self, app, control: ControlAdmision = control_admision):
+        self.app = app
+        self.control = control
+
+    async def __call__(self, scope, receive, send):
+        if not ADMISION_ACTIVA or scope["type"] != "http" or scope["path"] in RUTAS_EXENTAS:
+            await self.app(scope, receive, send)
+            return
+
+        escritura = scope["method"] in METODOS_ESCRITURA
+        espera = (self.control.escrituras if escritura else self.control.lecturas).tomar(cliente_de(scope))
+        if espera:
+            self.control.rechazos["limite_escrituras" if escritura else "limite_lecturas"] += 1
+            await _rechazar(send, 429, "Demasiados requests, probar mas tarde", espera)
+            return
+        if not escritura or ESCRITURAS_CONCURRENTES <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        if not await self.control.entrar():
+            await _rechazar(send, 503, "Servidor ocupado, probar mas tarde", 1)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.control.salir()
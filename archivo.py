@@ -0,0 +1,61 @@
+import os
+from datetime import date, timedelta
+
+from sqlalchemy import delete, func, insert, select, union_all
+from sqlalchemy.orm import Session
+
+from database import TurnoArchivadoDB, TurnoDB
+from estadoEnum import EstadoEnum
+from utils import VENTANA_CANCELADOS
+
+# Archivo de turnos: los turnos terminados con mas de HORIZONTE_ARCHIVO_DIAS se mueven
+# de turnos (tabla caliente) a turnos_archivo. Las reservas, la disponibilidad y el
+# contador de cancelados solo miran turnos; los reportes con rango de fechas suman el
+# archivo cuando el rango lo alcanza. El horizonte nunca es menor que la ventana de
+# cancelados, para que el contador no pierda turnos
+HORIZONTE_ARCHIVO_DIAS = max(int(os.getenv("ARCHIVO_HORIZONTE_DIAS", "365")), VENTANA_CANCELADOS + 1)
+
+# Solo se archivan turnos que ya no pueden cambiar de estado
+ESTADOS_ARCHIVABLES = [EstadoEnum.ASISTIDO, EstadoEnum.CANCELADO, EstadoEnum.VENCIDO]
+
+COLUMNAS_ARCHIVO = ["id", "fecha", "hora", "estado", "id_persona", "id_agenda", "cupo"]
+
+# Mueve un lote de turnos viejos al archivo (INSERT ... SELECT y DELETE en la misma
+# transaccion) y devuelve cuantos movio
+def archivar_lote(session: Session, tamanio: int, hoy: date = None) -> int:
+    hoy = hoy or date.today()
+    ids = [id for (id,) in session.query(TurnoDB.id).filter(
+        TurnoDB.estado.in_(ESTADOS_ARCHIVABLES),
+        TurnoDB.fecha < hoy - timedelta(days=HORIZONTE_ARCHIVO_DIAS)
+    ).order_by(TurnoDB.estado, TurnoDB.fecha).limit(tamanio)]
+    if not ids:
+        return 0
+    session.execute(insert(TurnoArchivadoDB).from_select(
+        COLUMNAS_ARCHIVO,
+        select(*(getattr(TurnoDB, columna) for columna in COLUMNAS_ARCHIVO)).where(TurnoDB.id.in_(ids))
+    ))
+    session.execute(delete(TurnoDB).where(TurnoDB.id.in_(ids)), execution_options={"synchronize_session": False})
+    return len(ids)
+
+# ---------- Lectura -------------
+
+# Fecha del turno archivado mas nuevo (None si el archivo esta vacio)
+def select_fecha_max_archivo():
+    return select(func.max(TurnoArchivadoDB.fecha))
+
+# Tablas que hay que leer para turnos desde `desde` (None: sin limite). El archivo
+# solo entra si tiene turnos de esas fechas
+def modelos_turnos(fecha_max_archivo: date, desde: date = None) -> tuple:
+    if fecha_max_archivo is not None and (desde is None or desde <= fecha_max_archivo):
+        return (TurnoDB, TurnoArchivadoDB)
+    return (TurnoDB,)
+
+# Arma la misma consulta sobre cada tabla y las une. construir(modelo) devuelve un
+# select con columnas del modelo; el resultado se puede ordenar por nombre de columna
+# (la union va en una subconsulta porque SQLite no siempre resuelve el ORDER BY de un
+# UNION por nombre)
+def unir_turnos(construir, modelos):
+    consultas = [construir(modelo) for modelo in modelos]
+    if len(consultas) == 1:
+        return consultas[0]
+    return select(union_all(*consultas).subquery())
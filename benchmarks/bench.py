@@ -0,0 +1,219 @@
+"""Benchmark de la API de turnos.
+
+Crea una base SQLite temporal con datos sinteticos, levanta la app de main.py
+en proceso (TestClient) y le tira cargas mixtas desde varios hilos. Al final
+imprime un JSON con throughput y latencias p50/p95/p99 por endpoint.
+
+    python benchmarks/bench.py --personas 2000 --turnos 20000 --requests 2000 --hilos 8
+    python benchmarks/bench.py --carga reservas --salida bench.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from entorno import preparar_app, sembrar_personas
+
+ESTADOS = ["PENDIENTE", "CONFIRMADO", "CANCELADO", "ASISTIDO"]
+
+# Peso de cada operacion en cada tipo de carga
+CARGAS = {
+    "mixta": {"reserva": 3, "disponibles": 3, "disponibles_rango": 1, "listado": 2, "turno": 2, "reporte_fecha": 1, "reporte_cancelados": 1, "reporte_rango": 1},
+    "reservas": {"reserva": 1},
+    "disponibilidad": {"disponibles": 3, "disponibles_rango": 1},
+    "listados": {"listado": 1, "turno": 1},
+    "reportes": {"reporte_fecha": 1, "reporte_cancelados": 1, "reporte_rango": 1},
+}
+
+def percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    k = (len(valores) - 1) * p / 100
+    i = int(k)
+    j = min(i + 1, len(valores) - 1)
+    return valores[i] + (valores[j] - valores[i]) * (k - i)
+
+# Carga N personas y M turnos repartidos en `dias` dias alrededor de hoy, sin
+# repetir lugar (fecha, hora) entre turnos activos
+def sembrar(database, horarios, personas: int, turnos: int, dias: int, rng: random.Random):
+    from sqlalchemy import insert
+
+    hoy = date.today()
+    with database.engine.begin() as conexion:
+        sembrar_personas(conexion, database, personas, "bench.test", 10000000, rng)
+
+        ocupados = set()
+        filas = []
+        while len(filas) < turnos:
+            fecha = hoy + timedelta(days=rng.randrange(-dias // 2, dias // 2))
+            hora = rng.choice(horarios)
+            estado = rng.choice(ESTADOS)
+            if estado != "CANCELADO":
+                if (fecha, hora) in ocupados:
+                    if len(ocupados) >= dias * len(horarios):
+                        estado = "CANCELADO"
+                    else:
+                        continue
+                else:
+                    ocupados.add((fecha, hora))
+            filas.append({"fecha": fecha, "hora": hora, "estado": estado, "id_persona": rng.randrange(personas) + 1})
+        for i in range(0, len(filas), 5000):
+            conexion.execute(insert(database.TurnoDB), filas[i:i + 5000])
+
+def armar_operaciones(personas: int, turnos: int, dias: int):
+    hoy = date.today()
+
+    def reserva(rng):
+        fecha = hoy + timedelta(days=rng.randrange(1, dias // 2))
+        hora = "{:02d}:{:02d}".format(rng.randrange(9, 17), rng.choice([0, 30]))
+        return "POST /turno", "post", "/turno", {"json": {"fecha": fecha.isoformat(), "hora": hora, "id_persona": rng.randrange(personas) + 1}}
+
+    def disponibles(rng):
+        fecha = hoy + timedelta(days=rng.randrange(0, dias // 2))
+        return "GET /turnos-disponibles", "get", "/turnos-disponibles", {"params": {"fecha": fecha.isoformat()}}
+
+    def disponibles_rango(rng):
+        desde = hoy + timedelta(days=rng.randrange(0, dias // 4 + 1))
+        return "GET /turnos-disponibles (30 dias)", "get", "/turnos-disponibles", {"params": {"desde": desde.isoformat(), "hasta": (desde + timedelta(days=29)).isoformat()}}
+
+    def listado(rng):
+        return "GET /turnos", "get", "/turnos", {"params": {"limit": 100, "cursor": rng.randrange(max(turnos - 100, 1))}}
+
+    def turno(rng):
+        return "GET /turno/{id}", "get", "/turno/{}".format(rng.randrange(turnos) + 1), {}
+
+    def reporte_fecha(rng):
+        fecha = hoy + timedelta(days=rng.randrange(-dias // 2, dias // 2))
+        return "GET /reportes/turnos-por-fecha", "get", "/reportes/turnos-por-fecha", {"params": {"fecha": fecha.isoformat()}}
+
+    def reporte_cancelados(rng):
+        return "GET /reportes/turnos-cancelados", "get", "/reportes/turnos-cancelados", {"params": {"min": 3}}
+
+    def reporte_rango(rng):
+        desde = hoy + timedelta(days=rng.randrange(-dias // 2, dias // 2))
+        return "GET /reportes/turnos-confirmados", "get", "/reportes/turnos-confirmados", {"params": {"desde": desde.isoformat(), "hasta": (desde + timedelta(days=7)).isoformat()}}
+
+    return {
+        "reserva": reserva,
+        "disponibles": disponibles,
+        "disponibles_rango": disponibles_rango,
+        "listado": listado,
+        "turno": turno,
+        "reporte_fecha": reporte_fecha,
+        "reporte_cancelados": reporte_cancelados,
+        "reporte_rango": reporte_rango,
+    }
+
+def correr(client, operaciones, pesos: dict, requests: int, hilos: int, seed: int):
+    nombres = list(pesos)
+    lock = threading.Lock()
+    latencias = defaultdict(list)
+    status = defaultdict(lambda: defaultdict(int))
+
+    def trabajar(n_hilo: int, cantidad: int):
+        rng = random.Random(seed * 1000 + n_hilo)
+        propias = defaultdict(list)
+        propios = defaultdict(lambda: defaultdict(int))
+        for _ in range(cantidad):
+            endpoint, metodo, url, kwargs = operaciones[rng.choices(nombres, weights=[pesos[n] for n in nombres])[0]](rng)
+            inicio = time.perf_counter()
+            respuesta = getattr(client, metodo)(url, **kwargs)
+            propias[endpoint].append((time.perf_counter() - inicio) * 1000)
+            propios[endpoint][respuesta.status_code] += 1
+        with lock:
+            for endpoint, valores in propias.items():
+                latencias[endpoint].extend(valores)
+            for endpoint, codigos in propios.items():
+                for codigo, cantidad_codigo in codigos.items():
+                    status[endpoint][codigo] += cantidad_codigo
+
+    por_hilo = [requests // hilos + (1 if i < requests % hilos else 0) for i in range(hilos)]
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        for futuro in [pool.submit(trabajar, i, cantidad) for i, cantidad in enumerate(por_hilo)]:
+            futuro.result()
+    duracion = time.perf_counter() - inicio
+
+    resultados = {}
+    for endpoint in sorted(latencias):
+        valores = sorted(latencias[endpoint])
+        resultados[endpoint] = resumir(valores, status[endpoint], duracion)
+    todas = sorted(v for valores in latencias.values() for v in valores)
+    todos_status = defaultdict(int)
+    for codigos in status.values():
+        for codigo, cantidad in codigos.items():
+            todos_status[codigo] += cantidad
+    return resultados, resumir(todas, todos_status, duracion), duracion
+
+def resumir(valores: list, status: dict, duracion: float) -> dict:
+    return {
+        "requests": len(valores),
+        "errores": sum(cantidad for codigo, cantidad in status.items() if codigo >= 500),
+        "status": {str(codigo): status[codigo] for codigo in sorted(status)},
+        "throughput_rps": round(len(valores) / duracion, 2) if duracion else 0.0,
+        "p50_ms": round(percentil(valores, 50), 3),
+        "p95_ms": round(percentil(valores, 95), 3),
+        "p99_ms": round(percentil(valores, 99), 3),
+        "max_ms": round(valores[-1], 3) if valores else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--personas", type=int, default=1000)
+    parser.add_argument("--turnos", type=int, default=10000)
+    parser.add_argument("--dias", type=int, default=120, help="dias cubiertos por los turnos sembrados (mitad pasados, mitad futuros)")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--hilos", type=int, default=8)
+    parser.add_argument("--carga", choices=sorted(CARGAS), default="mixta")
+    parser.add_argument("--seed", type=int, default=12)
+    parser.add_argument("--salida", help="archivo donde guardar el JSON (por defecto stdout)")
+    args = parser.parse_args()
+
+    salida_archivo = os.path.abspath(args.salida) if args.salida else None
+
+    database, app = preparar_app("bench-turnos-")
+
+    from fastapi.testclient import TestClient
+
+    from horarios import config_horarios
+
+    rng = random.Random(args.seed)
+    inicio = time.perf_counter()
+    sembrar(database, list(config_horarios.horarios()), args.personas, args.turnos, args.dias, rng)
+    siembra = time.perf_counter() - inicio
+
+    operaciones = armar_operaciones(args.personas, args.turnos, args.dias)
+    with TestClient(app) as client:
+        resultados, total, duracion = correr(client, operaciones, CARGAS[args.carga], args.requests, args.hilos, args.seed)
+
+    reporte = {
+        "config": {
+            "personas": args.personas,
+            "turnos": args.turnos,
+            "dias": args.dias,
+            "requests": args.requests,
+            "hilos": args.hilos,
+            "carga": args.carga,
+            "seed": args.seed,
+            "python": sys.version.split()[0],
+        },
+        "siembra_s": round(siembra, 3),
+        "duracion_s": round(duracion, 3),
+        "total": total,
+        "endpoints": resultados,
+    }
+    salida = json.dumps(reporte, indent=2, sort_keys=True)
+    if salida_archivo:
+        with open(salida_archivo, "w", encoding="utf-8") as archivo:
+            archivo.write(salida + "\n")
+    else:
+        print(salida)
+
+if __name__ == "__main__":
+    main()
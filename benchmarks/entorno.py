@@ -0,0 +1,47 @@
+"""Arranque comun de los scripts de benchmarks/.
+
+Deja la app de main.py lista para usar en proceso (TestClient) sobre una base
+SQLite nueva en un directorio temporal, y siembra personas de prueba.
+"""
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+# Configura el entorno antes de importar la app (lee la configuracion al importarse),
+# crea las tablas y devuelve (database, app)
+def preparar_app(prefijo: str):
+    directorio = tempfile.mkdtemp(prefix=prefijo)
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(directorio, "tp_python.db") #nunca contra la base configurada
+    os.environ.pop("ASYNC_DATABASE_URL", None)
+    os.environ["MANTENIMIENTO"] = "0" #que no cambie los datos sembrados durante la corrida
+    #todos los hilos son el mismo cliente: sin limite por cliente (el de escrituras concurrentes queda)
+    os.environ["LIMITE_LECTURAS_POR_SEG"] = "0"
+    os.environ["LIMITE_ESCRITURAS_POR_SEG"] = "0"
+
+    import database
+    import main as app_main
+
+    database.init_db()
+    return database, app_main.app
+
+# Inserta `cantidad` personas habilitadas (ids 1..cantidad en una base nueva). Con rng
+# las fechas de nacimiento son al azar; sin rng, todas iguales
+def sembrar_personas(conexion, database, cantidad: int, dominio: str, dni_base: int, rng=None):
+    from sqlalchemy import insert
+
+    conexion.execute(insert(database.PersonaDB), [
+        {
+            "nombre": "Persona {}".format(i),
+            "email": "persona{}@{}".format(i, dominio),
+            "dni": dni_base + i,
+            "telefono": 1100000000 + i,
+            "fecha_nacimiento": date(1950, 1, 1) + timedelta(days=rng.randrange(20000)) if rng else date(1990, 1, 1),
+            "habilitado": True,
+            "cancelados_recientes": 0,
+        }
+        for i in range(cantidad)
+    ])
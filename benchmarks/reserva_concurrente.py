@@ -0,0 +1,65 @@
+"""Prueba de estres de reservas simultaneas.
+
+Levanta la app de main.py en proceso (TestClient) sobre una base SQLite temporal
+y en cada ronda tira muchos POST /turno en paralelo, todos al mismo lugar
+(fecha, hora) y cada uno de una persona distinta. Tiene que ganar exactamente
+uno (201) y el resto recibir 409; si no, termina con codigo de salida 1.
+
+    python benchmarks/reserva_concurrente.py --hilos 32 --rondas 20
+"""
+import argparse
+import json
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from entorno import preparar_app, sembrar_personas
+
+# Todos los hilos esperan en la barrera y salen juntos contra el mismo lugar
+def ronda(client, pool, hilos: int, fecha: date, hora: str) -> Counter:
+    barrera = threading.Barrier(hilos)
+
+    def reservar(id_persona: int) -> int:
+        barrera.wait()
+        respuesta = client.post("/turno", json={"fecha": fecha.isoformat(), "hora": hora, "id_persona": id_persona})
+        return respuesta.status_code
+
+    return Counter(pool.map(reservar, range(1, hilos + 1)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hilos", type=int, default=16, help="reservas simultaneas por ronda")
+    parser.add_argument("--rondas", type=int, default=10, help="cada ronda usa un lugar distinto")
+    args = parser.parse_args()
+
+    database, app = preparar_app("estres-turnos-")
+
+    from fastapi.testclient import TestClient
+
+    from horarios import config_horarios
+
+    with database.engine.begin() as conexion:
+        sembrar_personas(conexion, database, args.hilos, "estres.test", 20000000)
+    horarios = [horario.strftime("%H:%M") for horario in config_horarios.horarios()]
+
+    resultados = []
+    with TestClient(app) as client, ThreadPoolExecutor(max_workers=args.hilos) as pool:
+        for n in range(args.rondas):
+            fecha = date.today() + timedelta(days=1 + n // len(horarios))
+            hora = horarios[n % len(horarios)]
+            status = ronda(client, pool, args.hilos, fecha, hora)
+            resultados.append({
+                "fecha": fecha.isoformat(),
+                "hora": hora,
+                "status": {str(codigo): status[codigo] for codigo in sorted(status)},
+                "ok": status[201] == 1 and status[409] == args.hilos - 1,
+            })
+
+    print(json.dumps({"hilos": args.hilos, "rondas": resultados}, indent=2))
+    if not all(resultado["ok"] for resultado in resultados):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
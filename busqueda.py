@@ -0,0 +1,157 @@
+import re
+import unicodedata
+
+from sqlalchemy import and_, delete, event, exists, insert, inspect, or_, select
+from sqlalchemy.orm import Session, aliased
+
+from database import PersonaDB, PersonaPalabraDB, engine
+
+# Busqueda de personas por nombre, DNI o email. Los nombres y la parte local del email
+# se parten en palabras normalizadas (minusculas y sin tildes) en personas_palabras, y
+# se busca por prefijo de palabra con un rango sobre el indice: "jose per" encuentra a
+# "José Pérez". El DNI se busca por prefijo con rangos sobre el indice de dni, y el
+# email completo por prefijo sobre su indice unico
+
+# Maximo de resultados por busqueda
+BUSQUEDA_MAX = 50
+
+# Cota superior de los rangos de prefijo: ningun texto normalizado la supera
+_FIN_PREFIJO = "\uffff"
+
+# Cantidad de digitos de un DNI valido (ver PersonaCreate)
+_DIGITOS_DNI = (7, 8)
+
+# Personas que se indexan por lote al armar el indice de una base existente
+TAMANIO_LOTE_BUSQUEDA = 1000
+
+#Minusculas y sin tildes ni dieresis (la ñ queda como n)
+def normalizar(texto: str) -> str:
+    descompuesto = unicodedata.normalize("NFKD", texto.lower())
+    return "".join(c for c in descompuesto if not unicodedata.combining(c))
+
+def palabras_de(texto: str) -> set[str]:
+    return {palabra for palabra in re.split(r"[^a-z0-9]+", normalizar(texto)) if palabra}
+
+#Palabras de una persona: las del nombre y las de la parte local del email
+def palabras_de_persona(nombre: str, email: str) -> set[str]:
+    return palabras_de(nombre) | palabras_de(email.split("@")[0])
+
+# ---------- Indice -------------
+
+#Personas a reindexar antes del commit. Las altas con session.execute (importacion
+#masiva) tienen que marcarlas a mano
+def marcar_personas(session: Session, ids):
+    session.info.setdefault("personas_busqueda", set()).update(id for id in ids if id is not None)
+
+def indexar_personas(session: Session, ids):
+    ids = list(ids)
+    for i in range(0, len(ids), TAMANIO_LOTE_BUSQUEDA):
+        lote = ids[i:i + TAMANIO_LOTE_BUSQUEDA]
+        session.execute(delete(PersonaPalabraDB).where(PersonaPalabraDB.id_persona.in_(lote)))
+        filas = [
+            {"palabra": palabra, "id_persona": id}
+            for id, nombre, email in session.query(PersonaDB.id, PersonaDB.nombre, PersonaDB.email).filter(PersonaDB.id.in_(lote))
+            for palabra in palabras_de_persona(nombre, email)
+        ]
+        if filas:
+            session.execute(insert(PersonaPalabraDB), filas)
+
+#Las personas borradas salen del indice solas (ON DELETE CASCADE)
+def _despues_de_flush(session, flush_context):
+    ids = {objeto.id for objeto in session.new if isinstance(objeto, PersonaDB)}
+    for objeto in session.dirty:
+        if isinstance(objeto, PersonaDB):
+            estado = inspect(objeto)
+            if estado.attrs.nombre.history.has_changes() or estado.attrs.email.history.has_changes():
+                ids.add(objeto.id)
+    if ids:
+        marcar_personas(session, ids)
+
+def _antes_de_commit(session):
+    session.flush()
+    ids = session.info.pop("personas_busqueda", None)
+    if ids:
+        indexar_personas(session, ids)
+
+def activar_busqueda():
+    if not event.contains(Session, "before_commit", _antes_de_commit):
+        event.listen(Session, "after_flush", _despues_de_flush)
+        event.listen(Session, "before_commit", _antes_de_commit)
+
+#Si el indice esta vacio y hay personas (base anterior a la busqueda) se arma entero, por lotes
+def inicializar_busqueda(bind=engine):
+    with Session(bind) as session:
+        if session.query(PersonaPalabraDB.id_persona).first() is not None:
+            return
+        ultimo = 0
+        while True:
+            ids = [id for (id,) in session.query(PersonaDB.id).filter(PersonaDB.id > ultimo).order_by(PersonaDB.id).limit(TAMANIO_LOTE_BUSQUEDA)]
+            if not ids:
+                break
+            indexar_personas(session, ids)
+            session.commit()
+            ultimo = ids[-1]
+
+# ---------- Consulta -------------
+
+def _prefijo(columna, prefijo: str):
+    return and_(columna >= prefijo, columna < prefijo + _FIN_PREFIJO)
+
+#Rangos de DNI que empiezan con esos digitos, uno por cada largo de DNI posible
+def _rangos_dni(digitos: str):
+    rangos = []
+    for largo in _DIGITOS_DNI:
+        if len(digitos) <= largo:
+            escala = 10 ** (largo - len(digitos))
+            rangos.append(PersonaDB.dni.between(int(digitos) * escala, (int(digitos) + 1) * escala - 1))
+    return rangos
+
+#Personas que tienen, para cada palabra buscada, alguna palabra que empieza asi. Se
+#recorre el indice de la palabra mas larga (la mas selectiva) en orden y se piden mas
+#filas hasta juntar limite personas distintas (una persona aparece una vez por palabra)
+def _ids_por_palabras(session: Session, palabras: list[str], limite: int) -> list[int]:
+    palabras = sorted(palabras, key=len, reverse=True)
+    consulta = select(PersonaPalabraDB.palabra, PersonaPalabraDB.id_persona).where(
+        _prefijo(PersonaPalabraDB.palabra, palabras[0])
+    )
+    for palabra in palabras[1:]:
+        otra = aliased(PersonaPalabraDB)
+        consulta = consulta.where(exists().where(
+            otra.id_persona == PersonaPalabraDB.id_persona,
+            _prefijo(otra.palabra, palabra)
+        ))
+    consulta = consulta.order_by(PersonaPalabraDB.palabra, PersonaPalabraDB.id_persona).limit(limite)
+
+    ids, ultimo = [], None
+    while len(ids) < limite:
+        pagina = consulta
+        if ultimo is not None:
+            pagina = pagina.where(or_(
+                PersonaPalabraDB.palabra > ultimo[0],
+                and_(PersonaPalabraDB.palabra == ultimo[0], PersonaPalabraDB.id_persona > ultimo[1])
+            ))
+        filas = session.execute(pagina).all()
+        for _, id in filas:
+            if id not in ids:
+                ids.append(id)
+        if len(filas) < limite:
+            break
+        ultimo = filas[-1]
+    return ids[:limite]
+
+#Hasta limite personas que coinciden con q: primero por DNI, despues por email y despues por nombre
+def buscar_personas(session: Session, q: str, limite: int) -> list[PersonaDB]:
+    q = q.strip()
+    ids = []
+    #un rango por consulta: con los dos en un OR y el LIMIT, SQLite recorre todo el indice
+    for rango in (_rangos_dni(q) if q.isdigit() else []):
+        ids += [id for (id,) in session.query(PersonaDB.id).filter(rango).order_by(PersonaDB.dni).limit(limite)]
+    email = q.lower()
+    ids += [id for (id,) in session.query(PersonaDB.id).filter(_prefijo(PersonaDB.email, email)).order_by(PersonaDB.email).limit(limite)]
+    palabras = palabras_de(q)
+    if palabras:
+        ids += _ids_por_palabras(session, list(palabras), limite)
+
+    ids = list(dict.fromkeys(ids))[:limite]
+    personas = {persona.id: persona for persona in session.query(PersonaDB).filter(PersonaDB.id.in_(ids))}
+    return [personas[id] for id in ids if id in personas]
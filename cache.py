@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import parse_qsl
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Segundos que vive una respuesta cacheada. Acota lo desactualizado que puede quedar
+# un worker cuando la escritura la hizo otro proceso (las versiones son por proceso)
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAX_ENTRADAS = int(os.getenv("CACHE_MAX_ENTRADAS", "512"))
+# Respuestas mas grandes que esto no se guardan
+CACHE_MAX_BYTES = 2 * 1024 * 1024
+
+# Endpoints GET que se cachean (por prefijo del path) y las tablas de las que dependen
+RUTAS_CACHEABLES = (
+    ("/turnos-disponibles", ("turnos", "agendas")),
+    ("/reportes/estado-personas", ("personas",)),
+    ("/reportes/", ("turnos", "turnos_archivo", "personas")),
+)
+
+# Distingue los ETag de cada proceso: dos workers pueden tener las mismas versiones con datos distintos
+_ID_PROCESO = uuid.uuid4().hex
+
+# Contador de version por tabla. Cada commit que escribe una tabla le suma 1, y como
+# la version es parte de la clave del cache, lo cacheado con la version vieja deja de usarse
+class VersionesTablas:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versiones = {}
+
+    def incrementar(self, tablas):
+        with self._lock:
+            for tabla in tablas:
+                self._versiones[tabla] = self._versiones.get(tabla, 0) + 1
+
+    def de(self, tablas) -> tuple:
+        return tuple(self._versiones.get(tabla, 0) for tabla in tablas)
+
+versiones = VersionesTablas()
+
+# Cache LRU con vencimiento
+class CacheLRU:
+
+    def __init__(self, max_entradas: int = CACHE_MAX_ENTRADAS, ttl: float = CACHE_TTL):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entradas = OrderedDict()
+
+    def get(self, clave):
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                return None
+            if entrada[0] < time.monotonic():
+                del self._entradas[clave]
+                return None
+            self._entradas.move_to_end(clave)
+            return entrada[1]
+
+    def set(self, clave, valor):
+        with self._lock:
+            self._entradas[clave] = (time.monotonic() + self.ttl, valor)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+
+cache_respuestas = CacheLRU()
+
+# ---------- Invalidacion por escrituras -------------
+
+def _anotar_tablas(session: Session, tablas):
+    session.info.setdefault("tablas_modificadas", set()).update(tablas)
+
+def _despues_de_flush(session, flush_context):
+    _anotar_tablas(session, {
+        objeto.__table__.name
+        for objeto in list(session.new) + list(session.dirty) + list(session.deleted)
+        if hasattr(objeto, "__table__")
+    })
+
+#INSERT/UPDATE/DELETE ejecutados con session.execute (altas masivas, updates por lote)
+def _al_ejecutar(estado):
+    if estado.is_insert or estado.is_update or estado.is_delete:
+        tabla = getattr(estado.statement, "table", None)
+        if tabla is not None:
+            _anotar_tablas(estado.session, {tabla.name})
+
+def _despues_de_commit(session):
+    tablas = session.info.pop("tablas_modificadas", None)
+    if tablas:
+        versiones.incrementar(tablas)
+
+# Engancha los eventos de todas las sesiones (las async usan una Session sync por debajo)
+def activar_invalidacion():
+    if not event.contains(Session, "after_commit", _despues_de_commit):
+        event.listen(Session, "after_flush", _despues_de_flush)
+        event.listen(Session, "do_orm_execute", _al_ejecutar)
+        event.listen(Session, "after_commit", _despues_de_commit)
+
+# ---------- Middleware -------------
+
+def _tablas_de(path: str):
+    for prefijo, tablas in RUTAS_CACHEABLES:
+        if path.startswith(prefijo):
+            return tablas
+    return None
+
+# Cachea las respuestas JSON 200 de los endpoints de RUTAS_CACHEABLES. La clave es
+# (path, parametros, versiones de las tablas); el ETag sale de la clave, asi que un
+# If-None-Match que coincide con una entrada vigente se contesta con 304 sin ejecutar nada
+class CacheMiddleware:
+
+    def __init__(self, app, cache: CacheLRU = cache_respuestas):
+        self.app = app
+        self.cache = cache
+
+    async def __call__(self, scope, receive, send):
+        tablas = _tablas_de(scope["path"]) if scope["type"] == "http" and scope["method"] == "GET" else None
+        if tablas is None:
+            await self.app(scope, receive, send)
+            return
+
+        parametros = tuple(sorted(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True)))
+        clave = (scope["path"], parametros, versiones.de(tablas))
+        etag = '"{}"'.format(hashlib.sha1(repr((_ID_PROCESO, clave)).encode()).hexdigest()[:20])
+
+        entrada = self.cache.get(clave)
+        if entrada is not None:
+            status, headers, body, ruta = entrada
+            scope["route"] = ruta #para que las metricas lo cuenten en su endpoint
+            if etag in _if_none_match(scope):
+                await send({"type": "http.response.start", "status": 304, "headers": [(b"etag", etag.encode())]})
+                await send({"type": "http.response.body", "body": b""})
+                return
+            await send({"type": "http.response.start", "status": status, "headers": headers + [(b"x-cache", b"HIT")]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        respuesta = {"status": None, "headers": None, "body": [], "bytes": 0, "guardar": False}
+
+        async def send_guardando(mensaje):
+            if mensaje["type"] == "http.response.start":
+                headers = list(mensaje.get("headers", []))
+                tipo = dict(headers).get(b"content-type", b"")
+                respuesta["guardar"] = mensaje["status"] == 200 and tipo.startswith(b"application/json")
+                if respuesta["guardar"]:
+                    headers.append((b"etag", etag.encode()))
+                    respuesta["status"], respuesta["headers"] = mensaje["status"], headers
+                    mensaje = dict(mensaje, headers=headers + [(b"x-cache", b"MISS")])
+            elif mensaje["type"] == "http.response.body" and respuesta["guardar"]:
+                respuesta["body"].append(mensaje.get("body", b""))
+                respuesta["bytes"] += len(mensaje.get("body", b""))
+                if respuesta["bytes"] > CACHE_MAX_BYTES:
+                    respuesta["guardar"] = False
+                    respuesta["body"] = []
+                elif not mensaje.get("more_body", False):
+                    self.cache.set(clave, (respuesta["status"], respuesta["headers"], b"".join(respuesta["body"]), scope.get("route")))
+            await send(mensaje)
+
+        await self.app(scope, receive, send_guardando)
+
+def _if_none_match(scope) -> list[str]:
+    for nombre, valor in scope["headers"]:
+        if nombre == b"if-none-match":
+            return [etag.strip().removeprefix("W/") for etag in valor.decode("latin-1").split(",")]
+    return []
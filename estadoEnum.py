@@ -4,4 +4,5 @@ class EstadoEnum(str, enum.Enum):
     PENDIENTE = "PENDIENTE"
     CONFIRMADO = "CONFIRMADO"
     CANCELADO = "CANCELADO"
-    ASISTIDO = "ASISTIDO"
\ No newline at end of file
+    ASISTIDO = "ASISTIDO"
+    VENCIDO = "VENCIDO" # paso la fecha sin que se resuelva (lo marca el mantenimiento)
@@ -0,0 +1,63 @@
+import csv
+import io
+import json
+from datetime import date, time
+
+from fastapi.responses import StreamingResponse
+
+from database import SessionLocal
+
+# Formatos de los reportes: json (respuesta entera) o csv/ndjson (en streaming)
+PATRON_FORMATO = r"^(json|csv|ndjson)$"
+
+# Filas que se traen de la base por vuelta (yield_per) y que se escriben por chunk
+TAMANIO_LOTE = 1000
+
+def _valor(valor):
+    if isinstance(valor, (date, time)):
+        return valor.isoformat()
+    return valor
+
+# Recorre la consulta en lotes con su propia sesion: la respuesta se sigue enviando
+# despues de que termina el endpoint, asi que no puede usar la sesion del request
+def _filas(consulta, a_dict):
+    session = SessionLocal()
+    try:
+        for fila in session.execute(consulta, execution_options={"yield_per": TAMANIO_LOTE}):
+            yield a_dict(fila)
+    finally:
+        session.close()
+
+def _csv(filas, columnas):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columnas)
+    writer.writeheader()
+    for n, fila in enumerate(filas, start=1):
+        writer.writerow({columna: _valor(fila[columna]) for columna in columnas})
+        if n % TAMANIO_LOTE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _ndjson(filas):
+    lote = []
+    for fila in filas:
+        lote.append(json.dumps(fila, default=_valor, ensure_ascii=False))
+        if len(lote) == TAMANIO_LOTE:
+            yield "\n".join(lote) + "\n"
+            lote = []
+    if lote:
+        yield "\n".join(lote) + "\n"
+
+# Devuelve un reporte como CSV o NDJSON sin cargarlo entero en memoria.
+# consulta es un select (o una union) y a_dict pasa cada fila a un dict con las columnas
+def exportar(consulta, a_dict, columnas: list[str], formato: str, nombre: str) -> StreamingResponse:
+    filas = _filas(consulta, a_dict)
+    if formato == "csv":
+        return StreamingResponse(
+            _csv(filas, columnas),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": 'attachment; filename="{}.csv"'.format(nombre)}
+        )
+    return StreamingResponse(_ndjson(filas), media_type="application/x-ndjson")
@@ -0,0 +1,44 @@
+import json
+import os
+import threading
+from datetime import datetime, time
+
+# El archivo se busca al lado del codigo, no en el directorio desde donde se levanta la app
+RUTA_HORARIOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "horarios.json")
+
+# Horarios de atencion leidos de horarios.json. El archivo se parsea una sola vez
+# y se guardan los time ya convertidos; en cada acceso solo se compara el mtime
+# del archivo y si cambio se vuelve a leer.
+class ConfigHorarios:
+
+    def __init__(self, ruta: str = RUTA_HORARIOS):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._mtime = None
+        # (lista ordenada, set para buscar en O(1)), se reemplazan juntos
+        self._datos: tuple[tuple[time, ...], frozenset[time]] = ((), frozenset())
+
+    def _cargar(self, mtime: float):
+        with open(self.ruta, "r", encoding="utf-8") as archivo:
+            horarios_json = json.load(archivo)
+        horarios = tuple(sorted(datetime.strptime(h, "%H:%M").time() for h in horarios_json["horarios"]))
+        self._datos = (horarios, frozenset(horarios))
+        self._mtime = mtime
+
+    def _actualizar(self):
+        mtime = os.stat(self.ruta).st_mtime
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._cargar(mtime)
+        return self._datos
+
+    #Horarios posibles ordenados
+    def horarios(self) -> tuple[time, ...]:
+        return self._actualizar()[0]
+
+    #True si la hora es uno de los horarios posibles
+    def es_valido(self, hora: time) -> bool:
+        return hora in self._actualizar()[1]
+
+config_horarios = ConfigHorarios()
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import time
+
+from sqlalchemy import and_, delete, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from admision import cliente_de
+from database import ClaveIdempotenciaDB, async_engine
+
+# Idempotency-Key en las altas: si el cliente reintenta un POST con la misma clave se
+# le devuelve la respuesta del primer intento en lugar de ejecutarlo otra vez. Las
+# claves se guardan en la base (claves_idempotencia), asi valen entre procesos y
+# reinicios: la fila se inserta antes de ejecutar el request y el indice unico por
+# (cliente, ruta, clave) deja pasar a uno solo de dos intentos simultaneos; la misma
+# clave de dos clientes no se cruza. El mantenimiento borra las vencidas y, si quedan
+# mas de IDEMPOTENCIA_MAX_ENTRADAS, las mas viejas
+IDEMPOTENCIA_TTL = float(os.getenv("IDEMPOTENCIA_TTL", "86400"))
+IDEMPOTENCIA_MAX_ENTRADAS = int(os.getenv("IDEMPOTENCIA_MAX_ENTRADAS", "10000"))
+# Segundos despues de los que un intento que sigue en curso se da por abandonado (el
+# proceso se corto antes de guardar la respuesta) y un reintento lo puede tomar
+IDEMPOTENCIA_EN_CURSO_MAX = float(os.getenv("IDEMPOTENCIA_EN_CURSO_MAX", "60"))
+# Largo maximo de la clave
+MAX_LARGO_CLAVE = 255
+
+# Endpoints POST que aceptan Idempotency-Key
+RUTAS_IDEMPOTENTES = ("/turno", "/personas")
+
+# Ademas de los 5xx no se guardan los "proba mas tarde", para que el reintento se
+# ejecute de verdad
+_NO_GUARDAR = (408, 429)
+
+def _clave_de(scope) -> str:
+    for nombre, valor in scope["headers"]:
+        if nombre == b"idempotency-key":
+            return valor.decode("latin-1").strip()
+    return None
+
+#Ruta de la app que atiende el path, para que las metricas cuenten la respuesta
+#repetida en su endpoint
+def _ruta_de(scope):
+    app = scope.get("app")
+    for ruta in (app.router.routes if app is not None else []):
+        if getattr(ruta, "path", None) == scope["path"] and "POST" in getattr(ruta, "methods", ()):
+            return ruta
+    return None
+
+async def _responder(send, status: int, detalle: str, headers=()):
+    body = json.dumps({"detail": detalle}).encode()
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), *headers
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+#Borra hasta `tamanio` claves, de la mas vieja en adelante: las vencidas y las que pasan
+#de IDEMPOTENCIA_MAX_ENTRADAS. Devuelve cuantas borro
+def purgar_lote(session: Session, tamanio: int, ahora: float = None) -> int:
+    ahora = ahora if ahora is not None else time.time()
+    sobrantes = session.query(func.count(ClaveIdempotenciaDB.id)).scalar() - IDEMPOTENCIA_MAX_ENTRADAS
+    filas = session.query(ClaveIdempotenciaDB.id, ClaveIdempotenciaDB.creada).order_by(
+        ClaveIdempotenciaDB.creada
+    ).limit(tamanio).all()
+    ids = [id for i, (id, creada) in enumerate(filas) if i < sobrantes or creada < ahora - IDEMPOTENCIA_TTL]
+    if ids:
+        session.execute(delete(ClaveIdempotenciaDB).where(ClaveIdempotenciaDB.id.in_(ids)))
+    return len(ids)
+
+# Guarda la respuesta de cada (cliente, endpoint, clave) junto con un hash del body. Repetir la
+# clave con el mismo body devuelve la respuesta guardada (header Idempotent-Replayed);
+# con otro body es un 422, y mientras el primer intento sigue en curso un 409
+class IdempotenciaMiddleware:
+
+    def __init__(self, app, bind=async_engine):
+        self.app = app
+        self.bind = bind
+
+    #Toma la clave para este request: la inserta, o pisa la fila si esta vencida o quedo
+    #de un intento abandonado. Devuelve (creada, None) si la tomo, o (None, fila existente).
+    #creada identifica al intento, para que uno abandonado que termina tarde no pise al nuevo
+    async def _tomar(self, cliente: str, ruta: str, clave: str, huella: str):
+        filtro = and_(ClaveIdempotenciaDB.cliente == cliente, ClaveIdempotenciaDB.ruta == ruta, ClaveIdempotenciaDB.clave == clave)
+        while True:
+            ahora = time.time()
+            try:
+                async with self.bind.begin() as conexion:
+                    await conexion.execute(insert(ClaveIdempotenciaDB).values(cliente=cliente, ruta=ruta, clave=clave, huella=huella, creada=ahora))
+                return ahora, None
+            except IntegrityError:
+                pass
+            async with self.bind.begin() as conexion:
+                tomada = await conexion.execute(update(ClaveIdempotenciaDB).where(filtro).where(or_(
+                    ClaveIdempotenciaDB.creada < ahora - IDEMPOTENCIA_TTL,
+                    and_(ClaveIdempotenciaDB.status.is_(None), ClaveIdempotenciaDB.creada < ahora - IDEMPOTENCIA_EN_CURSO_MAX)
+                )).values(huella=huella, creada=ahora, status=None, headers=None, body=None))
+                if tomada.rowcount:
+                    return ahora, None
+                fila = (await conexion.execute(select(
+                    ClaveIdempotenciaDB.huella, ClaveIdempotenciaDB.status, ClaveIdempotenciaDB.headers, ClaveIdempotenciaDB.body
+                ).where(filtro))).first()
+            if fila is not None:
+                return None, fila
+            #la purgaron entre el INSERT y la consulta: se vuelve a intentar
+
+    def _del_intento(self, cliente: str, ruta: str, clave: str, creada: float):
+        return and_(ClaveIdempotenciaDB.cliente == cliente, ClaveIdempotenciaDB.ruta == ruta, ClaveIdempotenciaDB.clave == clave, ClaveIdempotenciaDB.creada == creada)
+
+    async def __call__(self, scope, receive, send):
+        clave = None
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in RUTAS_IDEMPOTENTES:
+            clave = _clave_de(scope)
+        if clave is None:
+            await self.app(scope, receive, send)
+            return
+        if not clave or len(clave) > MAX_LARGO_CLAVE:
+            await _responder(send, 400, "Idempotency-Key debe tener entre 1 y {} caracteres".format(MAX_LARGO_CLAVE))
+            return
+
+        #el body se lee entero para compararlo con el del primer intento
+        partes = []
+        while True:
+            mensaje = await receive()
+            if mensaje["type"] != "http.request":
+                return
+            partes.append(mensaje.get("body", b""))
+            if not mensaje.get("more_body", False):
+                break
+        body = b"".join(partes)
+        huella = hashlib.sha256(body).hexdigest()
+        cliente = cliente_de(scope)
+        ruta = scope["path"]
+
+        creada, fila = await self._tomar(cliente, ruta, clave, huella)
+        if fila is not None:
+            if fila.huella != huella:
+                await _responder(send, 422, "La Idempotency-Key ya se uso con otro body")
+            elif fila.status is None:
+                await _responder(send, 409, "Hay un request con la misma Idempotency-Key en curso", [(b"retry-after", b"1")])
+            else:
+                scope["route"] = _ruta_de(scope) #para que las metricas lo cuenten en su endpoint
+                headers = [(nombre.encode("latin-1"), valor.encode("latin-1")) for nombre, valor in json.loads(fila.headers)]
+                await send({"type": "http.response.start", "status": fila.status, "headers": headers + [(b"idempotent-replayed", b"true")]})
+                await send({"type": "http.response.body", "body": fila.body})
+            return
+
+        body_entregado = False
+
+        async def receive_con_body():
+            nonlocal body_entregado
+            if not body_entregado:
+                body_entregado = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        respuesta = {"status": None, "headers": None, "body": [], "guardada": False}
+
+        #la respuesta se guarda antes de mandar el final del body, asi un reintento que
+        #llega apenas el cliente la recibio ya la encuentra
+        async def send_guardando(mensaje):
+            if mensaje["type"] == "http.response.start":
+                respuesta["status"], respuesta["headers"] = mensaje["status"], list(mensaje.get("headers", []))
+            elif mensaje["type"] == "http.response.body":
+                respuesta["body"].append(mensaje.get("body", b""))
+                status = respuesta["status"]
+                if not mensaje.get("more_body", False) and status < 500 and status not in _NO_GUARDAR:
+                    headers = [[nombre.decode("latin-1"), valor.decode("latin-1")] for nombre, valor in respuesta["headers"]]
+                    async with self.bind.begin() as conexion:
+                        await conexion.execute(update(ClaveIdempotenciaDB).where(self._del_intento(cliente, ruta, clave, creada)).values(
+                            status=status, headers=json.dumps(headers), body=b"".join(respuesta["body"])
+                        ))
+                    respuesta["guardada"] = True
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive_con_body, send_guardando)
+        finally:
+            #sin respuesta guardada la clave se libera para que el reintento se ejecute
+            if not respuesta["guardada"]:
+                async with self.bind.begin() as conexion:
+                    await conexion.execute(delete(ClaveIdempotenciaDB).where(
+                        self._del_intento(cliente, ruta, clave, creada), ClaveIdempotenciaDB.status.is_(None)
+                    ))
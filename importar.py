@@ -0,0 +1,210 @@
+import json
+from collections import defaultdict
+
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import AgendaDB, PersonaDB, TurnoDB
+from estadoEnum import EstadoEnum
+from models import PersonaCreate, TurnoCreate
+from busqueda import marcar_personas
+from rollup import marcar_fechas
+from utils import TAMANIO_LOTE_IN, horario_valido, recalcular_cancelados_personas
+
+# Filas que se validan e insertan por transaccion
+TAMANIO_LOTE_IMPORTACION = 1000
+
+TIPOS_NDJSON = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+# Lee el body como NDJSON (una fila por linea) o como un array JSON y lo devuelve en lotes
+# de (numero de fila, dict | error). El NDJSON se procesa a medida que llega
+async def leer_lotes(request: Request):
+    lote = []
+    if request.headers.get("content-type", "").split(";")[0].strip() in TIPOS_NDJSON:
+        fila = 0
+        async for linea in _lineas(request):
+            if not linea.strip():
+                continue
+            fila += 1
+            try:
+                lote.append((fila, json.loads(linea)))
+            except ValueError:
+                lote.append((fila, "JSON invalido"))
+            if len(lote) == TAMANIO_LOTE_IMPORTACION:
+                yield lote
+                lote = []
+    else:
+        try:
+            filas = json.loads(await request.body())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="El body debe ser un array JSON o NDJSON")
+        if not isinstance(filas, list):
+            raise HTTPException(status_code=400, detail="El body debe ser un array JSON o NDJSON")
+        for i in range(0, len(filas), TAMANIO_LOTE_IMPORTACION):
+            yield list(enumerate(filas[i:i + TAMANIO_LOTE_IMPORTACION], start=i + 1))
+    if lote:
+        yield lote
+
+async def _lineas(request: Request):
+    resto = b""
+    async for chunk in request.stream():
+        resto += chunk
+        *lineas, resto = resto.split(b"\n")
+        for linea in lineas:
+            yield linea
+    if resto:
+        yield resto
+
+def _validar(modelo, lote):
+    validas, resultados = [], {}
+    for fila, datos in lote:
+        if isinstance(datos, str):
+            resultados[fila] = {"fila": fila, "ok": False, "error": datos}
+            continue
+        try:
+            validas.append((fila, modelo.model_validate(datos)))
+        except ValidationError as e:
+            errores = "; ".join("{}: {}".format(".".join(str(x) for x in err["loc"]), err["msg"]) for err in e.errors())
+            resultados[fila] = {"fila": fila, "ok": False, "error": errores}
+    return validas, resultados
+
+def _en_lotes(valores):
+    valores = list(valores)
+    for i in range(0, len(valores), TAMANIO_LOTE_IN):
+        yield valores[i:i + TAMANIO_LOTE_IN]
+
+# Inserta las filas con un solo INSERT ... RETURNING id. Si otro request inserto un
+# duplicado entre la verificacion y el INSERT, se reintenta de a una con savepoints.
+# Los savepoints quedan dentro de la transaccion del lote (con SQLite la abre
+# _savepoint_sqlite en database.py), asi nada se commitea antes del commit del lote
+def _insertar(session: Session, modelo_db, filas: list, resultados: dict):
+    if not filas:
+        return
+    try:
+        with session.begin_nested():
+            ids = session.execute(
+                insert(modelo_db).returning(modelo_db.id, sort_by_parameter_order=True),
+                [valores for _, valores in filas]
+            ).scalars().all()
+        for (fila, _), id in zip(filas, ids):
+            resultados[fila] = {"fila": fila, "ok": True, "id": id}
+    except IntegrityError:
+        for fila, valores in filas:
+            try:
+                with session.begin_nested():
+                    id = session.execute(insert(modelo_db).returning(modelo_db.id), valores).scalar_one()
+                resultados[fila] = {"fila": fila, "ok": True, "id": id}
+            except IntegrityError as e:
+                resultados[fila] = {"fila": fila, "ok": False, "error": "Error de integridad: {}".format(e.orig)}
+
+# Valida e inserta un lote de personas en una transaccion. DNI y email repetidos se
+# buscan con un IN por lote, tanto contra la base como dentro del mismo lote
+def importar_lote_personas(session: Session, lote: list) -> list[dict]:
+    validas, resultados = _validar(PersonaCreate, lote)
+
+    dnis = {persona.dni for _, persona in validas}
+    emails = {persona.email.lower().strip() for _, persona in validas}
+    dnis_tomados, emails_tomados = set(), set()
+    for ids in _en_lotes(dnis):
+        dnis_tomados.update(dni for (dni,) in session.query(PersonaDB.dni).filter(PersonaDB.dni.in_(ids)))
+    for ids in _en_lotes(emails):
+        emails_tomados.update(email for (email,) in session.query(PersonaDB.email).filter(PersonaDB.email.in_(ids)))
+
+    filas = []
+    for fila, persona in validas:
+        email = persona.email.lower().strip()
+        if persona.dni in dnis_tomados:
+            resultados[fila] = {"fila": fila, "ok": False, "error": "El DNI ya está registrado."}
+        elif email in emails_tomados:
+            resultados[fila] = {"fila": fila, "ok": False, "error": "El email ya está registrado."}
+        else:
+            dnis_tomados.add(persona.dni)
+            emails_tomados.add(email)
+            filas.append((fila, {
+                "nombre": persona.nombre.strip(),
+                "email": email,
+                "dni": persona.dni,
+                "telefono": persona.telefono,
+                "fecha_nacimiento": persona.fecha_nacimiento,
+                "habilitado": True,
+                "cancelados_recientes": 0
+            }))
+
+    _insertar(session, PersonaDB, filas, resultados)
+    marcar_personas(session, [resultados[fila]["id"] for fila, _ in filas if resultados[fila]["ok"]])
+    session.commit()
+    return [resultados[fila] for fila, _ in lote]
+
+# Valida e inserta un lote de turnos en una transaccion. Como es una importacion de
+# historicos se aceptan fechas pasadas y el estado que venga en cada fila; lo que se
+# controla es que la persona y la agenda existan, que el horario sea valido para la
+# agenda y que quede algun cupo libre en ese horario
+def importar_lote_turnos(session: Session, lote: list) -> list[dict]:
+    validas, resultados = _validar(TurnoCreate, lote)
+
+    personas_existentes = set()
+    for ids in _en_lotes({turno.id_persona for _, turno in validas}):
+        personas_existentes.update(id for (id,) in session.query(PersonaDB.id).filter(PersonaDB.id.in_(ids)))
+
+    agendas = {}
+    for ids in _en_lotes({turno.id_agenda for _, turno in validas}):
+        agendas.update((agenda.id, agenda) for agenda in session.query(AgendaDB).filter(AgendaDB.id.in_(ids)))
+
+    # (agenda, fecha, hora) -> cupos ocupados por turnos activos
+    cupos_tomados = defaultdict(set)
+    for fechas in _en_lotes({turno.fecha for _, turno in validas if turno.estado != EstadoEnum.CANCELADO}):
+        for id_agenda, fecha, hora, cupo in session.query(TurnoDB.id_agenda, TurnoDB.fecha, TurnoDB.hora, TurnoDB.cupo).filter(
+            TurnoDB.fecha.in_(fechas),
+            TurnoDB.id_agenda.in_(list(agendas)),
+            TurnoDB.estado != EstadoEnum.CANCELADO
+        ):
+            cupos_tomados[(id_agenda, fecha, hora)].add(cupo)
+
+    filas = []
+    for fila, turno in validas:
+        agenda = agendas.get(turno.id_agenda)
+        cupo = 1
+        if turno.id_persona not in personas_existentes:
+            resultados[fila] = {"fila": fila, "ok": False, "error": "La persona no esta cargada en la base de datos"}
+            continue
+        if agenda is None:
+            resultados[fila] = {"fila": fila, "ok": False, "error": "La agenda indicada no existe"}
+            continue
+        if not horario_valido(agenda, turno.hora):
+            resultados[fila] = {"fila": fila, "ok": False, "error": "El horario no esta dentro de los horarios de atencion"}
+            continue
+        if turno.estado != EstadoEnum.CANCELADO:
+            tomados = cupos_tomados[(agenda.id, turno.fecha, turno.hora)]
+            libres = [n for n in range(1, agenda.capacidad + 1) if n not in tomados]
+            if len(tomados) >= agenda.capacidad or not libres:
+                resultados[fila] = {"fila": fila, "ok": False, "error": "El turno ya esta tomado en esa fecha y hora"}
+                continue
+            cupo = libres[0]
+            tomados.add(cupo)
+        filas.append((fila, {
+            "fecha": turno.fecha,
+            "hora": turno.hora,
+            "estado": turno.estado.value,
+            "id_persona": turno.id_persona,
+            "id_agenda": agenda.id,
+            "cupo": cupo
+        }))
+
+    _insertar(session, TurnoDB, filas, resultados)
+    marcar_fechas(session, {valores["fecha"] for fila, valores in filas if resultados[fila]["ok"]})
+
+    #los cancelados importados cuentan para la habilitacion de la persona
+    con_cancelados = {
+        valores["id_persona"] for fila, valores in filas
+        if valores["estado"] == EstadoEnum.CANCELADO and resultados[fila]["ok"]
+    }
+    recalcular_cancelados_personas(con_cancelados, session)
+    session.commit()
+    return [resultados[fila] for fila, _ in lote]
+
+def resumen_importacion(resultados: list[dict]) -> dict:
+    creados = sum(1 for resultado in resultados if resultado["ok"])
+    return {"creados": creados, "errores": len(resultados) - creados, "resultados": resultados}
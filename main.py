@@ -1,22 +1,64 @@
+import calendar
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, date
-from fastapi import FastAPI, HTTPException, status
-from models import PersonaConTurnosOut, PersonaCreate, PersonaOut, PersonaOutTurno, PersonaUpdate, TurnoOut, TurnoCreate, TurnoConPersonaOut, TurnoEstadoUpdate
-from database import session, PersonaDB, TurnoDB
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, status
+from models import AgendaCreate, AgendaOut, PaginaPersonas, PaginaTurnos, PersonaConTurnosOut, PersonaCreate, PersonaOut, PersonaUpdate, TurnoOut, TurnoCreate, TurnoConPersonaOut, TurnoEstadoUpdate, TurnosEstadoLote
+from database import AGENDA_GENERAL, async_engine, engine, get_async_session, get_session, init_db, AgendaDB, PersonaDB, TurnoArchivadoDB, TurnoDB
+from exportar import PATRON_FORMATO, exportar
+from cache import CacheMiddleware, activar_invalidacion
+from idempotencia import IdempotenciaMiddleware
+from admision import AdmisionMiddleware, control_admision
+from rollup import activar_rollup, estadisticas_turnos, inicializar_rollup
+from busqueda import BUSQUEDA_MAX, activar_busqueda, buscar_personas, inicializar_busqueda
+from metricas import MetricasMiddleware, respuesta_metricas
+from mantenimiento import planificador
+from archivo import modelos_turnos, select_fecha_max_archivo, unir_turnos
+from traza_sql import TRAZA_SQL_ACTIVA, TrazaSQLMiddleware, activar_traza_sql
+from importar import importar_lote_personas, importar_lote_turnos, leer_lotes, resumen_importacion
+from proyecciones import RespuestaJSON, fila_a_turno, fila_a_turno_con_persona, select_turnos, select_turnos_con_persona, turno_con_persona_de
 from utils import *
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import extract
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload
+from typing import List, Optional
 from estadoEnum import EstadoEnum
 from fastapi import HTTPException
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_db()
+    inicializar_rollup()
+    inicializar_busqueda()
+    planificador.iniciar()
+    yield
+    await planificador.detener()
+    await async_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
+activar_invalidacion()
+activar_rollup()
+activar_busqueda()
+app.add_middleware(CacheMiddleware)
+app.add_middleware(IdempotenciaMiddleware)
+app.add_middleware(AdmisionMiddleware)
+app.add_middleware(MetricasMiddleware)
+if TRAZA_SQL_ACTIVA:
+    activar_traza_sql(engine, async_engine)
+    app.add_middleware(TrazaSQLMiddleware)
 
 @app.get("/")
 async def root():
     return {"msg": "API funcionando"}
 
+#Metricas de latencia, requests y errores por endpoint en formato Prometheus
+@app.get("/metrics", include_in_schema=False)
+def exportar_metricas():
+    return respuesta_metricas(planificador.exportar(), control_admision.exportar())
+
 @app.post("/personas", response_model=PersonaOut ,status_code=status.HTTP_201_CREATED) 
-def crear_persona(persona: PersonaCreate):
+def crear_persona(persona: PersonaCreate, session: Session = Depends(get_session)):
     try:
         dni_valido = session.query(PersonaDB).filter(PersonaDB.dni == persona.dni).first()
         if dni_valido:
@@ -49,36 +91,68 @@ def crear_persona(persona: PersonaCreate):
         raise HTTPException(status_code=400, detail=str(e))
     return to_persona_out(persona_nueva)
 
+#Alta masiva de personas: array JSON o NDJSON, devuelve el resultado de cada fila
+@app.post("/personas/bulk")
+async def importar_personas(request: Request, session: AsyncSession = Depends(get_async_session)):
+    resultados = []
+    async for lote in leer_lotes(request):
+        resultados.extend(await session.run_sync(importar_lote_personas, lote))
+    return resumen_importacion(resultados)
+
+#Busqueda por prefijo de nombre (sin importar tildes), DNI o email. Va antes de /personas/{id}
+@app.get("/personas/buscar", response_model=List[PersonaOut])
+def buscar_persona(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(10, ge=1, le=BUSQUEDA_MAX),
+    session: Session = Depends(get_session)
+):
+    return [to_persona_out(persona) for persona in buscar_personas(session, q, limit)]
+
 @app.get("/personas/{id}", response_model=PersonaOut, status_code=status.HTTP_200_OK)
-def listar_persona_por_id(id: int):
+def listar_persona_por_id(id: int, session: Session = Depends(get_session)):
     persona = session.query(PersonaDB).filter(PersonaDB.id == id).first()
     if not persona:
         raise HTTPException(status_code=404, detail="Persona no encontrada.")
     return to_persona_out(persona)
 
-@app.get("/personas") 
-def listar_personas(): 
-    personas = session.query(PersonaDB).all()
-    personasResponse: list[PersonaOut] = []
-    for persona in personas:
-        personasResponse.append(to_persona_out(persona))
-    return personasResponse
+#Get personas paginado por id (keyset): cursor es el ultimo id de la pagina anterior
+@app.get("/personas", response_model=PaginaPersonas)
+def listar_personas(
+    limit: int = Query(PAGINA_DEFAULT, ge=1, le=PAGINA_MAX),
+    cursor: Optional[int] = None,
+    habilitado: Optional[bool] = None,
+    session: Session = Depends(get_session)
+):
+    query = session.query(PersonaDB)
+    if cursor is not None:
+        query = query.filter(PersonaDB.id > cursor)
+    if habilitado is not None:
+        query = query.filter(PersonaDB.habilitado == habilitado)
+
+    personas, next_cursor = paginar(query.order_by(PersonaDB.id).limit(limit + 1).all(), limit)
+    return PaginaPersonas(
+        items=[to_persona_out(persona) for persona in personas],
+        next_cursor=next_cursor
+    )
 
 @app.delete("/personas/{id}", status_code=status.HTTP_204_NO_CONTENT)
-def eliminar_persona(id: int):
+def eliminar_persona(id: int, session: Session = Depends(get_session)):
     try:
         persona = session.query(PersonaDB).filter(PersonaDB.id == id).first()
         if not persona:
             raise HTTPException(status_code=404, detail="Persona no encontrada.")
         session.delete(persona)
         session.commit()
+    except IntegrityError: # con foreign_keys=ON la base no deja turnos sin persona
+        session.rollback()
+        raise HTTPException(status_code=400, detail="No se puede eliminar una persona que tiene turnos cargados.")
     except Exception as e:
         session.rollback()
         raise HTTPException(status_code=400, detail= str(e))
     return
 
 @app.put("/personas/{id}", response_model=PersonaOut)
-def modificar_persona(id:int, persona:PersonaCreate):
+def modificar_persona(id:int, persona:PersonaCreate, session: Session = Depends(get_session)):
     try:
         persona_cambio = session.query(PersonaDB).filter(PersonaDB.id == id).first()
         if persona_cambio is None:
@@ -106,7 +180,7 @@ def modificar_persona(id:int, persona:PersonaCreate):
     return to_persona_out(persona_cambio)
 
 @app.patch("/personas/{id}", response_model=PersonaOut)
-def patchPersona(id: int, persona: PersonaUpdate):
+def patchPersona(id: int, persona: PersonaUpdate, session: Session = Depends(get_session)):
     try:
         persona_cambio = session.query(PersonaDB).filter(PersonaDB.id == id).first()
         if persona_cambio is None:
@@ -132,10 +206,54 @@ def patchPersona(id: int, persona: PersonaUpdate):
 
     return to_persona_out(persona_cambio)
 
+################################## Agendas ###################################
+#Una agenda por profesional o consultorio, con sus horarios y la capacidad de cada horario
+@app.post("/agendas", response_model=AgendaOut, status_code=status.HTTP_201_CREATED)
+def crear_agenda(agenda: AgendaCreate, session: Session = Depends(get_session)):
+    agenda_nueva = AgendaDB(
+        nombre=agenda.nombre,
+        capacidad=agenda.capacidad,
+        horarios=horarios_a_texto(agenda.horarios) if agenda.horarios else None
+    )
+    session.add(agenda_nueva)
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(status_code=409, detail="Ya existe una agenda con ese nombre.")
+    return to_agenda_out(agenda_nueva)
+
+@app.get("/agendas", response_model=List[AgendaOut])
+def listar_agendas(session: Session = Depends(get_session)):
+    return [to_agenda_out(agenda) for agenda in session.query(AgendaDB).order_by(AgendaDB.id)]
+
+@app.get("/agendas/{id}", response_model=AgendaOut)
+def traer_agenda(id: int, session: Session = Depends(get_session)):
+    agenda = session.get(AgendaDB, id)
+    if not agenda:
+        raise HTTPException(status_code=404, detail="Agenda no encontrada.")
+    return to_agenda_out(agenda)
+
+#Cambiar horarios o capacidad no toca los turnos ya dados
+@app.put("/agendas/{id}", response_model=AgendaOut)
+def modificar_agenda(id: int, agenda: AgendaCreate, session: Session = Depends(get_session)):
+    agenda_cambio = session.get(AgendaDB, id)
+    if not agenda_cambio:
+        raise HTTPException(status_code=404, detail="Agenda no encontrada.")
+    agenda_cambio.nombre = agenda.nombre
+    agenda_cambio.capacidad = agenda.capacidad
+    agenda_cambio.horarios = horarios_a_texto(agenda.horarios) if agenda.horarios else None
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(status_code=409, detail="Ya existe una agenda con ese nombre.")
+    return to_agenda_out(agenda_cambio)
+
 ################################## Turnos ###################################
 #Post turno
 @app.post("/turno", response_model=TurnoConPersonaOut, status_code=status.HTTP_201_CREATED)
-def crear_turno(turno: TurnoCreate):
+def crear_turno(turno: TurnoCreate, session: Session = Depends(get_session)):
     try:
         #persona esta cargada en la base 
         persona = session.query (PersonaDB).filter(PersonaDB.id == turno.id_persona).first()
@@ -146,70 +264,113 @@ def crear_turno(turno: TurnoCreate):
         if not persona_habilitada (persona, session):
             raise Exception ("La persona no esta habilitada para sacar turnos, ya que tiene 5 o mas turnos cancelados en los ultimos 6 meses")
         
-        #verifico si el turno ya fue tomado
-        turno_tomado = session.query(TurnoDB).filter(
-            TurnoDB.fecha == turno.fecha,
-            TurnoDB.hora == turno.hora,
-            TurnoDB.estado != EstadoEnum.CANCELADO
-        ).first ()
-
-        if turno_tomado :
-            raise Exception ("El turno ya esta tomado en esa fecha y hora")
-        
+        agenda = session.get(AgendaDB, turno.id_agenda)
+        if not agenda:
+            raise Exception("La agenda indicada no existe")
 
         #verifico la hora
-        lista_horarios = [datetime.strptime(h, "%H:%M").time() for h in leer_horarios()]#paso a time
-        if turno.hora not in lista_horarios :
-            raise Exception ("El horario debe estar dentro del limite horario, los horarios se organizan en intervalos de media hora, desde las 09:00 hasta las 17:00")
+        if not horario_valido(agenda, turno.hora):
+            raise Exception ("El horario debe estar dentro de los horarios de atencion de la agenda, que se organizan en intervalos de media hora")
         
         #la fecha no podria ser anterior al dia en que se toma el turno
         fecha_actual = datetime.now()
         if turno.fecha < fecha_actual.date():
             raise Exception ( "La fecha no puede ser anterior a la fecha actual")
         
-        #si no tiene errores, se crea el turno en la base
-        turno_nuevo = TurnoDB(
-            fecha = turno.fecha,
-            hora= turno.hora, 
-            estado = EstadoEnum.PENDIENTE,
-            id_persona = turno.id_persona
-        )
-        
-        session.add(turno_nuevo)
+        #si no tiene errores, se crea el turno en la base, en un cupo libre del horario
+        turno_nuevo = TurnoDB()
+        valores = {
+            "fecha": turno.fecha,
+            "hora": turno.hora,
+            "estado": EstadoEnum.PENDIENTE,
+            "id_persona": turno.id_persona,
+            "id_agenda": agenda.id
+        }
+        if not ocupar_cupo(turno_nuevo, valores, agenda, session):
+            raise HTTPException(status_code=409, detail="El turno ya esta tomado en esa fecha y hora")
         session.commit()
         session.refresh(turno_nuevo)
 
-        return TurnoConPersonaOut(
-        id=turno_nuevo.id,
-        fecha=turno_nuevo.fecha,
-        hora=turno_nuevo.hora,
-        estado=turno_nuevo.estado,
-        persona=PersonaOutTurno(
-            id=persona.id,
-            nombre=persona.nombre,
-            dni=persona.dni,
-            fecha_nacimiento=persona.fecha_nacimiento,
-            edad=calcular_edad(persona.fecha_nacimiento)
-        )
-    )    
+        return turno_con_persona_de(turno_nuevo, persona)
+    except HTTPException:
+        session.rollback()
+        raise
+    except IntegrityError as e:
+        #otro request tomo el mismo lugar entre la verificacion y el commit
+        session.rollback()
+        if es_lugar_duplicado(e):
+            raise HTTPException(status_code=409, detail="El turno ya esta tomado en esa fecha y hora")
+        raise HTTPException(status_code=400, detail=str(e.orig))
     except Exception as e:
         session.rollback()
         raise HTTPException (status_code=400, detail= str(e))
     #devuelvo con algunos de los datos de la persona
 
+#Alta masiva de turnos (historicos o nuevos): array JSON o NDJSON, devuelve el resultado de cada fila
+@app.post("/turnos/bulk")
+async def importar_turnos(request: Request, session: AsyncSession = Depends(get_async_session)):
+    resultados = []
+    async for lote in leer_lotes(request):
+        resultados.extend(await session.run_sync(importar_lote_turnos, lote))
+    return resumen_importacion(resultados)
+
+#Cambio de estado de muchos turnos en una transaccion (confirmar la lista del dia,
+#marcar los asistidos): devuelve el resultado de cada id. Va antes de /turnos/{id}
+@app.put("/turnos/estado")
+def cambiar_estado_lote(cambio: TurnosEstadoLote, session: Session = Depends(get_session)):
+    try:
+        resultados = cambiar_estado_turnos(cambio.ids, cambio.estado, session)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
+    actualizados = sum(1 for resultado in resultados if resultado["ok"])
+    return {"actualizados": actualizados, "errores": len(resultados) - actualizados, "resultados": resultados}
+
 #Put turno
 @app.put("/turnos/{id}", response_model=TurnoOut)
-def modificar_Turno(id:int, turno:TurnoCreate):
+def modificar_Turno(id:int, turno:TurnoCreate, session: Session = Depends(get_session)):
     turno_cambio = session.query(TurnoDB).filter(TurnoDB.id == id).first()
     if turno_cambio is None:
         raise HTTPException(status_code=404, detail="Turno no encontrado.")
-    turno_cambio.fecha = turno.fecha #if turnoCambio.fecha is not None else None
-    turno_cambio.hora = turno.hora #if turnoCambio.hora is not None else None
-    turno_cambio.estado = turno.estado #if turno.estado is not None else None
-    turno_cambio.id_persona = turno.id_persona #if turnoCambio.id_persona is not None else None
+    agenda = session.get(AgendaDB, turno.id_agenda)
+    if agenda is None:
+        raise HTTPException(status_code=400, detail="La agenda indicada no existe.")
+    #si el turno se mueve de horario (o deja de estar cancelado) necesita un cupo libre en el nuevo
+    mismo_lugar = turno_cambio.estado != EstadoEnum.CANCELADO and (
+        turno_cambio.id_agenda, turno_cambio.fecha, turno_cambio.hora
+    ) == (turno.id_agenda, turno.fecha, turno.hora)
+    #si el turno estaba o queda CANCELADO, cambia el contador de cancelados de las personas
+    afecta_cancelados = EstadoEnum.CANCELADO in (turno_cambio.estado, turno.estado)
+    personas_afectadas = {turno_cambio.id_persona, turno.id_persona}
+    valores = {
+        "fecha": turno.fecha,
+        "hora": turno.hora,
+        "estado": turno.estado,
+        "id_persona": turno.id_persona,
+        "id_agenda": turno.id_agenda
+    }
     try:
+        if turno.estado != EstadoEnum.CANCELADO and not mismo_lugar:
+            if not ocupar_cupo(turno_cambio, valores, agenda, session):
+                session.rollback()
+                raise HTTPException(status_code=409, detail="El turno ya esta tomado en esa fecha y hora")
+        else:
+            for campo, valor in valores.items():
+                setattr(turno_cambio, campo, valor)
+        if afecta_cancelados:
+            session.flush()
+            for persona in session.query(PersonaDB).filter(PersonaDB.id.in_(personas_afectadas)):
+                recalcular_cancelados(persona, session)
         session.commit()
         session.refresh(turno_cambio)
+    except HTTPException:
+        raise
+    except IntegrityError as e:
+        session.rollback()
+        if es_lugar_duplicado(e):
+            raise HTTPException(status_code=409, detail="El turno ya esta tomado en esa fecha y hora")
+        raise HTTPException(status_code=400, detail="Error al modificar el turno.")
     except Exception:
         session.rollback()
         raise HTTPException(status_code=400, detail="Error al modificar el turno.")
@@ -218,7 +379,7 @@ def modificar_Turno(id:int, turno:TurnoCreate):
 
 #Delete turno (fisico)
 @app.delete("/turnos/{id}", status_code=status.HTTP_204_NO_CONTENT)
-def eliminar_turno(id: int):
+def eliminar_turno(id: int, session: Session = Depends(get_session)):
     try:
         turno = session.query(TurnoDB).filter(TurnoDB.id == id).first()
         if not turno:
@@ -227,160 +388,187 @@ def eliminar_turno(id: int):
         validar_estado_solo_asistido(turno)
         
         session.delete(turno)
+        if turno.estado == EstadoEnum.CANCELADO and turno.persona:
+            session.flush()
+            recalcular_cancelados(turno.persona, session)
         session.commit()
     except Exception as e:
         session.rollback()
         raise HTTPException(status_code=400, detail= str(e))
     return
 
-#Get todos los turnos con algun dato de la persona
-@app.get("/turnos", response_model=list[TurnoConPersonaOut])
-async def listar_turnos_tomados():
-    turnos_bd = session.query(TurnoDB, PersonaDB).join(PersonaDB).all()
-    
-    if not turnos_bd:
+#Get todos los turnos con algun dato de la persona, paginado por id y con filtros
+@app.get("/turnos", response_model=PaginaTurnos)
+async def listar_turnos_tomados(
+    limit: int = Query(PAGINA_DEFAULT, ge=1, le=PAGINA_MAX),
+    cursor: Optional[int] = None,
+    estado: Optional[EstadoEnum] = None,
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    id_persona: Optional[int] = None,
+    session: AsyncSession = Depends(get_async_session)
+):
+    query = select_turnos_con_persona()
+    if cursor is not None:
+        query = query.filter(TurnoDB.id > cursor)
+    if estado is not None:
+        query = query.filter(TurnoDB.estado == estado)
+    if desde is not None:
+        query = query.filter(TurnoDB.fecha >= desde)
+    if hasta is not None:
+        query = query.filter(TurnoDB.fecha <= hasta)
+    if id_persona is not None:
+        query = query.filter(TurnoDB.id_persona == id_persona)
+
+    filas = (await session.execute(query.order_by(TurnoDB.id).limit(limit + 1))).all()
+    filas, next_cursor = paginar(filas, limit)
+
+    #sin filtros una primera pagina vacia es que no hay turnos; con filtros es una pagina vacia
+    filtrado = any(filtro is not None for filtro in (estado, desde, hasta, id_persona))
+    if not filas and cursor is None and not filtrado:
         raise HTTPException(status_code=404, detail="No hay turnos cargados.")
-    
-    turnos= []
-    for turno, persona in turnos_bd:
-        turnos.append(TurnoConPersonaOut(
-            id=turno.id,
-            fecha=turno.fecha,
-            hora=turno.hora,
-            estado=turno.estado,
-            persona=PersonaOutTurno(
-                id=persona.id,
-                nombre=persona.nombre,
-                dni=persona.dni,
-                fecha_nacimiento=persona.fecha_nacimiento,
-                edad=calcular_edad(persona.fecha_nacimiento)
-            )
-        ))
-    return turnos
+
+    hoy = date.today()
+    return RespuestaJSON({"items": [fila_a_turno_con_persona(fila, hoy) for fila in filas], "next_cursor": next_cursor})
 
 #Get turnos por id
 @app.get("/turno/{id}", response_model=TurnoConPersonaOut)
-def traer_turno_id(id: int):
-    turno = session.query(TurnoDB).filter(TurnoDB.id == id).first()
-    if not turno:
+async def traer_turno_id(id: int, session: AsyncSession = Depends(get_async_session)):
+    fila = (await session.execute(select_turnos_con_persona().filter(TurnoDB.id == id))).first()
+    if not fila: #puede estar archivado
+        fila = (await session.execute(select_turnos_con_persona(TurnoArchivadoDB).filter(TurnoArchivadoDB.id == id))).first()
+    if not fila:
         raise HTTPException(status_code=404, detail="Turno no encontrado")
-    
+
 #muestro el turno con algunos datos de la persona
-    return TurnoConPersonaOut(
-        id=turno.id,
-        fecha=turno.fecha,
-        hora=turno.hora,
-        estado=turno.estado,
-        persona=PersonaOutTurno(
-            id=turno.persona.id,
-            nombre=turno.persona.nombre,
-            dni=turno.persona.dni,
-            fecha_nacimiento=turno.persona.fecha_nacimiento,
-            edad=calcular_edad(turno.persona.fecha_nacimiento)
-        )
-    )
+    return RespuestaJSON(fila_a_turno_con_persona(fila, date.today()))
 
-#Get turnos disponibles 
+#Get turnos disponibles de un dia (fecha) o de un rango de dias (desde/hasta). Sin agenda
+#es la agenda general; con ?agenda=1&agenda=2... se consultan varias agendas en la misma llamada
 @app.get("/turnos-disponibles")
-def traer_turnos_disponibles (fecha: str):
+async def traer_turnos_disponibles (
+    fecha: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    agenda: Optional[List[int]] = Query(None),
+    session: AsyncSession = Depends(get_async_session)
+):
+
+    if fecha is None and (desde is None or hasta is None):
+        raise HTTPException (status_code = 400, detail = "Se debe indicar una fecha, o un rango con desde y hasta")
 
     try:
-        fecha_date = datetime.strptime (fecha, "%Y-%m-%d").date() #paso a date
+        if fecha is not None:
+            desde_date = hasta_date = datetime.strptime (fecha, "%Y-%m-%d").date() #paso a date
+        else:
+            desde_date = datetime.strptime (desde, "%Y-%m-%d").date()
+            hasta_date = datetime.strptime (hasta, "%Y-%m-%d").date()
     except ValueError:
         raise HTTPException (status_code = 400, detail = "El formato de la fecha debe ser YYYY-MM-DD")
 
     #la fecha no podria ser anterior al dia en que se toma el turno
     fecha_actual = datetime.now()
-    if fecha_date < fecha_actual.date():
+    if desde_date < fecha_actual.date():
         raise HTTPException (status_code = 400, detail = "La fecha no puede ser anterior a la fecha actual")
 
-    ocupados = session.query(TurnoDB).filter(
-        TurnoDB.fecha == fecha_date,
-        TurnoDB.estado != EstadoEnum.CANCELADO
-    ).all()
-
-    #guardo los turnos cargados en la bd
-    ocupados = session.query(TurnoDB).filter( 
-        TurnoDB.fecha == fecha_date, TurnoDB.estado != EstadoEnum.CANCELADO
-    ).all()
-
-    tomados_horas = [ocupado.hora for ocupado in ocupados] #guardo las horas de los turnos que estan en la bd
-    horarios_disponibles = [to_time(h) for h in leer_horarios ()]
-    turnos_disponibles = [horario.strftime("%H:%M") for horario in horarios_disponibles if horario not in tomados_horas] #cargo todos los horarios disponibles, van a ser los que no esten en la lista de tomados horas
-    
-    return {"Fecha:": fecha, "Horarios disponibles:": turnos_disponibles} 
+    if hasta_date < desde_date:
+        raise HTTPException (status_code = 400, detail = "La fecha hasta no puede ser anterior a la fecha desde")
+
+    if (hasta_date - desde_date).days + 1 > MAX_DIAS_DISPONIBILIDAD:
+        raise HTTPException (status_code = 400, detail = "El rango no puede superar los {} dias".format(MAX_DIAS_DISPONIBILIDAD))
+
+    ids_agendas = list(dict.fromkeys(agenda or [AGENDA_GENERAL]))
+    if len(ids_agendas) > MAX_AGENDAS_DISPONIBILIDAD:
+        raise HTTPException (status_code = 400, detail = "No se pueden consultar mas de {} agendas a la vez".format(MAX_AGENDAS_DISPONIBILIDAD))
+    agendas_bd = (await session.execute(select(AgendaDB).filter(AgendaDB.id.in_(ids_agendas)))).scalars().all()
+    if len(agendas_bd) != len(ids_agendas):
+        raise HTTPException (status_code = 404, detail = "Agenda no encontrada")
+    agendas_bd = sorted(agendas_bd, key=lambda a: ids_agendas.index(a.id))
+
+    disponibles = await session.run_sync(lambda s: turnos_disponibles_por_dia(desde_date, hasta_date, agendas_bd, s))
+
+    if agenda is None:
+        por_dia = disponibles[AGENDA_GENERAL]
+        if fecha is not None:
+            return {"Fecha:": fecha, "Horarios disponibles:": por_dia[desde_date]}
+        return {
+            "Desde:": desde,
+            "Hasta:": hasta,
+            "Dias:": [
+                {"Fecha:": dia.isoformat(), "Horarios disponibles:": horarios}
+                for dia, horarios in por_dia.items()
+            ]
+        }
+
+    if fecha is not None:
+        return {
+            "Fecha:": fecha,
+            "Agendas:": [
+                {"id": a.id, "nombre": a.nombre, "Horarios disponibles:": disponibles[a.id][desde_date]}
+                for a in agendas_bd
+            ]
+        }
+    return {
+        "Desde:": desde,
+        "Hasta:": hasta,
+        "Agendas:": [
+            {
+                "id": a.id,
+                "nombre": a.nombre,
+                "Dias:": [
+                    {"Fecha:": dia.isoformat(), "Horarios disponibles:": horarios}
+                    for dia, horarios in disponibles[a.id].items()
+                ]
+            }
+            for a in agendas_bd
+        ]
+    }
 
 #Put Turno CANCELAR
 @app.put("/turno/{id}/cancelar", response_model= TurnoConPersonaOut)
-def actualizar_estado_turno_cancelar(id: int):
+def actualizar_estado_turno_cancelar(id: int, session: Session = Depends(get_session)):
     try:
-        turno = session.get(TurnoDB, id)
+        #la persona viene en la misma consulta (la necesitan el contador y la respuesta)
+        turno = session.get(TurnoDB, id, options=[joinedload(TurnoDB.persona)])
         if not turno:
             raise Exception("Turno no encontrado")
     
-    #valido si el estado no es CANCELADO o ASISTIDO
+    #valido si el estado no es CANCELADO, ASISTIDO o VENCIDO
         validar_estado(turno) 
         turno.estado = EstadoEnum.CANCELADO
         
-        persona_db = session.query (PersonaDB).filter(PersonaDB.id == turno.id_persona).first()
-        habilitada_persona= persona_habilitada (persona_db, session) 
+        registrar_cancelacion(turno.persona, turno, session)
 
         session.commit()
-        session.refresh(turno)
     except Exception as e:
         session.rollback()
         raise HTTPException(status_code=400, detail=str(e))
 
-    return TurnoConPersonaOut(
-        id=turno.id,
-        fecha=turno.fecha,
-        hora=turno.hora,
-        estado=turno.estado,
-        persona=PersonaOutTurno(
-            id=turno.persona.id,
-            nombre=turno.persona.nombre,
-            dni=turno.persona.dni,
-            fecha_nacimiento=turno.persona.fecha_nacimiento,
-            edad=calcular_edad(turno.persona.fecha_nacimiento)
-        )
-    )
+    return turno_con_persona_de(turno, turno.persona)
 
 #Put Turno CONFIRMAR
 @app.put("/turno/{id}/confirmar", response_model= TurnoConPersonaOut)
-def actualizar_estado_turno_confirmar(id: int, turno_update: TurnoEstadoUpdate):
+def actualizar_estado_turno_confirmar(id: int, turno_update: TurnoEstadoUpdate, session: Session = Depends(get_session)):
     try:
-        turno = session.get(TurnoDB, id)
+        turno = session.get(TurnoDB, id, options=[joinedload(TurnoDB.persona)])
         if not turno:
             raise Exception("Turno no encontrado")
     
-    #valido si el estado no es CANCELADO o ASISTIDO
+    #valido si el estado no es CANCELADO, ASISTIDO o VENCIDO
         validar_estado(turno)
 
         turno.estado = EstadoEnum.CONFIRMADO
         
         session.commit()
-        session.refresh(turno)
     except Exception as e:
         session.rollback()
         raise HTTPException(status_code=400, detail= str(e))
 
-    return TurnoConPersonaOut(
-        id=turno.id,
-        fecha=turno.fecha,
-        hora=turno.hora,
-        estado=turno.estado,
-        persona=PersonaOutTurno(
-            id=turno.persona.id,
-            nombre=turno.persona.nombre,
-            dni=turno.persona.dni,
-            fecha_nacimiento=turno.persona.fecha_nacimiento,
-            edad=calcular_edad(turno.persona.fecha_nacimiento)
-        )
-    )
+    return turno_con_persona_de(turno, turno.persona)
 
 #Patch Turno ASISTIDO solo para probar validaciones 
 @app.patch("/turno/{id}/asistido", response_model=TurnoOut)
-def actualizar_estado_turno_asistido(id: int):
+def actualizar_estado_turno_asistido(id: int, session: Session = Depends(get_session)):
     try:
         turno = session.get(TurnoDB, id)
         if not turno:
@@ -399,41 +587,35 @@ def actualizar_estado_turno_asistido(id: int):
 #Punto E 
 #Reportes por persona con el dni
 @app.get("/reportes/turnos-por-persona/{dni}", response_model=PersonaConTurnosOut)
-def reportes_turnos_por_persona(dni: int):
+async def reportes_turnos_por_persona(dni: int, session: AsyncSession = Depends(get_async_session)):
     try:
-        persona = obtener_persona_por_dni (dni, session)
-        turnos_bd = obtener_turnos_por_persona (persona.id, session)
-
-        turnos: list[TurnoOut] = [
-            TurnoOut(
-                id=turno.id,
-                fecha=turno.fecha,
-                hora=turno.hora,
-                estado=turno.estado,
-                id_persona=turno.id_persona
-            )
-            for turno in turnos_bd
-        ]
-
+        persona = await session.run_sync(lambda s: obtener_persona_por_dni (dni, s))
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) 
-    
-    return PersonaConTurnosOut(
-        id=persona.id,
-        nombre=persona.nombre,
-        dni=str(persona.dni), 
-        fecha_nacimiento=persona.fecha_nacimiento,
-        edad=calcular_edad(persona.fecha_nacimiento),
-        habilitado=persona.habilitado,
-        turnos=turnos
-    )
+
+    #todos los turnos de la persona: tambien los archivados, si hay archivo
+    modelos = modelos_turnos((await session.execute(select_fecha_max_archivo())).scalar())
+    consulta = unir_turnos(lambda modelo: select_turnos(modelo).filter(modelo.id_persona == persona.id), modelos)
+    filas = (await session.execute(consulta.order_by("id"))).all()
+    if not filas:
+        raise HTTPException(status_code=400, detail="La persona no tiene turnos asignados")
+
+    return RespuestaJSON({
+        "id": persona.id,
+        "nombre": persona.nombre,
+        "dni": str(persona.dni),
+        "fecha_nacimiento": persona.fecha_nacimiento,
+        "edad": calcular_edad(persona.fecha_nacimiento),
+        "habilitado": persona.habilitado,
+        "turnos": [fila_a_turno(fila) for fila in filas]
+    })
 
 #GET /reportes/turnos-cancelados?min=int
 @app.get("/reportes/turnos-cancelados")
-def reportes_personas_con_turnos_cancelados(min: int):
+async def reportes_personas_con_turnos_cancelados(min: int, session: AsyncSession = Depends(get_async_session)):
     try:
         limite= calcular_limite_fecha (180)
-        personas = obtener_personas_con_turnos_cancelados(session, limite, min)
+        personas = await session.run_sync(obtener_personas_con_turnos_cancelados, limite, min)
     except Exception as e:
         raise HTTPException(status_code=404, detail=str(e))
     
@@ -443,50 +625,79 @@ def reportes_personas_con_turnos_cancelados(min: int):
     }
 
 @app.get("/reportes/turnos-por-fecha", response_model=list[TurnoConPersonaOut])
-def turnos_por_fecha(fecha: date):
-    turnos = session.query(TurnoDB).join(PersonaDB).filter(TurnoDB.fecha == fecha).all()
-
-
-
-    resultado = []
-    for turno in turnos:
-        persona = turno.persona
-        persona_out = PersonaOutTurno(
-            id=persona.id,
-            nombre=persona.nombre,
-            dni=persona.dni,
-            fecha_nacimiento=persona.fecha_nacimiento,
-            edad=calcular_edad(persona.fecha_nacimiento)
-        )
-        resultado.append(
-            TurnoConPersonaOut(
-                id=turno.id,
-                fecha=turno.fecha,
-                hora=turno.hora,
-                estado=turno.estado,
-                persona=persona_out
-            )
+async def turnos_por_fecha(fecha: date, formato: str = Query("json", alias="format", pattern=PATRON_FORMATO), session: AsyncSession = Depends(get_async_session)):
+    hoy = date.today()
+    modelos = modelos_turnos((await session.execute(select_fecha_max_archivo())).scalar(), fecha)
+    consulta = unir_turnos(lambda modelo: select_turnos_con_persona(modelo).filter(modelo.fecha == fecha), modelos)
+    if formato != "json":
+        return exportar(
+            consulta.order_by("hora"),
+            lambda fila: {
+                "id": fila.id,
+                "fecha": fila.fecha,
+                "hora": fila.hora,
+                "estado": fila.estado,
+                "persona_id": fila.persona_id,
+                "nombre": fila.nombre,
+                "dni": fila.dni,
+                "fecha_nacimiento": fila.fecha_nacimiento,
+                "edad": calcular_edad(fila.fecha_nacimiento, hoy)
+            },
+            ["id", "fecha", "hora", "estado", "persona_id", "nombre", "dni", "fecha_nacimiento", "edad"],
+            formato,
+            "turnos-{}".format(fecha)
         )
-    if not resultado:
+
+    filas = (await session.execute(consulta.order_by("id"))).all()
+    if not filas:
         raise HTTPException(status_code=404, detail="No hay Turnos cargados para esa fecha.")
-    return resultado
+    return RespuestaJSON([fila_a_turno_con_persona(fila, hoy) for fila in filas])
 
 @app.get("/reportes/turnos-cancelados-por-mes")
-def turnos_cancelados_por_mes():
+async def turnos_cancelados_por_mes(
+    anio: Optional[int] = Query(None, ge=1900, le=9999),
+    mes: Optional[int] = Query(None, ge=1, le=12),
+    formato: str = Query("json", alias="format", pattern=PATRON_FORMATO),
+    session: AsyncSession = Depends(get_async_session)
+):
     hoy = datetime.today()
-    mes_actual = hoy.month
-    anio_actual = hoy.year
+    mes_actual = mes or hoy.month
+    anio_actual = anio or hoy.year
+
+    #rango del mes: con fechas (y no extract) la consulta usa el indice (estado, fecha)
+    primer_dia = date(anio_actual, mes_actual, 1)
+    ultimo_dia = date(anio_actual, mes_actual, calendar.monthrange(anio_actual, mes_actual)[1])
+    modelos = modelos_turnos((await session.execute(select_fecha_max_archivo())).scalar(), primer_dia)
+    consulta = unir_turnos(
+        lambda modelo: select(modelo.id, modelo.id_persona, modelo.fecha, modelo.hora, modelo.estado).filter(
+            (modelo.estado == "CANCELADO") & (modelo.fecha >= primer_dia) & (modelo.fecha <= ultimo_dia)
+        ),
+        modelos
+    ).order_by("id")
+
+    if formato != "json":
+        return exportar(
+            consulta,
+            lambda fila: {
+                "id": fila.id,
+                "persona_id": fila.id_persona,
+                "fecha": fila.fecha,
+                "hora": fila.hora.strftime("%H:%M"),
+                "estado": fila.estado
+            },
+            ["id", "persona_id", "fecha", "hora", "estado"],
+            formato,
+            "turnos-cancelados-{}-{:02d}".format(anio_actual, mes_actual)
+        )
 
-    turnos = session.query(TurnoDB).filter(
-        TurnoDB.estado == "CANCELADO",
-        extract("month", TurnoDB.fecha) == mes_actual,
-        extract("year", TurnoDB.fecha) == anio_actual
-    ).all()
+    #la cantidad sale del resumen por dia
+    estadisticas = await session.run_sync(lambda s: estadisticas_turnos(s, primer_dia, ultimo_dia))
+    turnos = (await session.execute(consulta)).all()
 
     resultado = {
         "anio": anio_actual,
         "mes": mes_actual,
-        "cantidad": len(turnos),
+        "cantidad": estadisticas["por_estado"][EstadoEnum.CANCELADO.value],
         "turnos": []
     }
 
@@ -502,23 +713,59 @@ def turnos_cancelados_por_mes():
         raise HTTPException(status_code=404, detail="No hay Turnos cancelados para ese mes.")
     return resultado
 
+# GET /reportes/estadisticas?desde=YYYY-MM-DD&hasta=YYYY-MM-DD o ?anio=YYYY&mes=MM
+#Cantidad de turnos por estado en el rango, sale del resumen por dia (turnos_por_dia)
+@app.get("/reportes/estadisticas")
+async def reportes_estadisticas(
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    anio: Optional[int] = Query(None, ge=1900, le=9999),
+    mes: Optional[int] = Query(None, ge=1, le=12),
+    por_dia: bool = False,
+    session: AsyncSession = Depends(get_async_session)
+):
+    if anio is not None and mes is not None:
+        desde = date(anio, mes, 1)
+        hasta = date(anio, mes, calendar.monthrange(anio, mes)[1])
+    elif desde is None or hasta is None:
+        raise HTTPException(status_code=400, detail="Se debe indicar desde y hasta, o anio y mes")
+
+    if hasta < desde:
+        raise HTTPException(status_code=400, detail="La fecha hasta no puede ser anterior a la fecha desde")
+
+    return await session.run_sync(lambda s: estadisticas_turnos(s, desde, hasta, por_dia))
+
 # GET /reportes/turnos-confirmados?desde=YYYY-MM-DD&hasta=YYYY-MM-DD
-@app.get("/reportes/turnos-confirmados")
-def reportes_turnos_entre_fechas(desde: date, hasta: date):
-    try:
-        turnos_confirmados = obtener_turnos_entre_fechas(desde, hasta, session)
-    except Exception as e:
-        raise HTTPException(status_code=404, detail=str(e))
+@app.get("/reportes/turnos-confirmados", response_model=list[TurnoOut])
+async def reportes_turnos_entre_fechas(desde: date, hasta: date, formato: str = Query("json", alias="format", pattern=PATRON_FORMATO), session: AsyncSession = Depends(get_async_session)):
+    #el archivo solo se consulta si el rango llega a fechas archivadas
+    modelos = modelos_turnos((await session.execute(select_fecha_max_archivo())).scalar(), desde)
+    consulta = unir_turnos(
+        lambda modelo: select_turnos(modelo).filter((modelo.fecha >= desde) & (modelo.fecha <= hasta)),
+        modelos
+    )
+    if formato != "json":
+        return exportar(
+            consulta.order_by("fecha", "hora"),
+            lambda fila: fila._asdict(),
+            ["id", "fecha", "hora", "estado", "id_persona", "id_agenda"],
+            formato,
+            "turnos-{}-{}".format(desde, hasta)
+        )
+
+    filas = (await session.execute(consulta.order_by("id"))).all()
+    if not filas:
+        raise HTTPException(status_code=404, detail="No hay turnos registrados entre esas fechas.")
 
-    return turnos_confirmados
+    return RespuestaJSON([fila_a_turno(fila) for fila in filas])
         
 
 # GET /reportes/estado-personas?habilitada=true/false
-@app.get("/reportes/estado-personas")
-def reportes_personas_estado_habilitacion(habilitada: bool):
+@app.get("/reportes/estado-personas", response_model=List[PersonaOut])
+async def reportes_personas_estado_habilitacion(habilitada: bool, session: AsyncSession = Depends(get_async_session)):
     try:
-        personas_por_estado = obtener_personas_por_estado(habilitada, session)
+        personas_por_estado = await session.run_sync(lambda s: obtener_personas_por_estado(habilitada, s))
     except Exception as e:
         raise HTTPException(status_code=404,detail=str(e))
     
-    return personas_por_estado
+    return [to_persona_out(persona) for persona in personas_por_estado]
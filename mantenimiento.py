@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import update
+
+from archivo import archivar_lote
+from database import PersonaDB, SessionLocal, TurnoDB
+from estadoEnum import EstadoEnum
+from idempotencia import purgar_lote
+from rollup import marcar_fechas
+from utils import recalcular_cancelados_personas
+
+# Mantenimiento en segundo plano: tareas que resuelven estado viejo con UPDATEs por
+# lote. Se apaga entero con MANTENIMIENTO=0; cada tarea tiene su intervalo en segundos
+# (MANTENIMIENTO_<TAREA>_CADA, 0 la apaga)
+MANTENIMIENTO_ACTIVO = os.getenv("MANTENIMIENTO", "1") == "1"
+
+# Filas por transaccion: lotes chicos para no tener tomada la escritura mucho tiempo
+TAMANIO_LOTE_MANTENIMIENTO = int(os.getenv("MANTENIMIENTO_LOTE", "500"))
+# Pausa entre lotes para dejar pasar a los requests que esperan para escribir
+PAUSA_ENTRE_LOTES = float(os.getenv("MANTENIMIENTO_PAUSA", "0.05"))
+# Segundos despues del arranque hasta la primera corrida
+DEMORA_INICIAL = float(os.getenv("MANTENIMIENTO_DEMORA_INICIAL", "5"))
+# Dias de gracia antes de vencer un turno: con 1, los de ayer siguen PENDIENTE o
+# CONFIRMADO hasta manana y en recepcion todavia los pueden marcar ASISTIDO
+DIAS_GRACIA_VENCER = int(os.getenv("MANTENIMIENTO_VENCER_DIAS", "1"))
+
+logger = logging.getLogger("mantenimiento")
+
+# ---------- Tareas -------------
+# Cada tarea hace lotes hasta que no queda nada y devuelve cuantas filas cambio
+
+#Turnos PENDIENTE o CONFIRMADO de hace mas de DIAS_GRACIA_VENCER dias quedan VENCIDO
+def vencer_turnos(hoy: date = None) -> int:
+    limite = (hoy or date.today()) - timedelta(days=DIAS_GRACIA_VENCER)
+    total = 0
+    while True:
+        with SessionLocal() as session:
+            filas = session.query(TurnoDB.id, TurnoDB.fecha).filter(
+                TurnoDB.estado.in_([EstadoEnum.PENDIENTE, EstadoEnum.CONFIRMADO]),
+                TurnoDB.fecha < limite
+            ).order_by(TurnoDB.estado, TurnoDB.fecha).limit(TAMANIO_LOTE_MANTENIMIENTO).all()
+            if not filas:
+                return total
+            session.execute(
+                update(TurnoDB)
+                .where(TurnoDB.id.in_([id for id, _ in filas]))
+                .where(TurnoDB.estado.in_([EstadoEnum.PENDIENTE, EstadoEnum.CONFIRMADO]))
+                .values(estado=EstadoEnum.VENCIDO),
+                execution_options={"synchronize_session": False}
+            )
+            marcar_fechas(session, {fecha for _, fecha in filas})
+            session.commit()
+        total += len(filas)
+        if len(filas) < TAMANIO_LOTE_MANTENIMIENTO:
+            return total
+        time.sleep(PAUSA_ENTRE_LOTES)
+
+#Personas con algun cancelado que ya salio de la ventana: se recalcula el contador y
+#habilitado. El recalculo deja cancelados_vencen en una fecha futura (o None), asi que
+#cada persona sale de la consulta despues de su lote
+def recalcular_habilitados(hoy: date = None) -> int:
+    hoy = hoy or date.today()
+    total = 0
+    while True:
+        with SessionLocal() as session:
+            ids = [id for (id,) in session.query(PersonaDB.id).filter(
+                PersonaDB.cancelados_vencen <= hoy
+            ).order_by(PersonaDB.cancelados_vencen).limit(TAMANIO_LOTE_MANTENIMIENTO)]
+            if not ids:
+                return total
+            recalcular_cancelados_personas(ids, session, hoy)
+            session.commit()
+        total += len(ids)
+        if len(ids) < TAMANIO_LOTE_MANTENIMIENTO:
+            return total
+        time.sleep(PAUSA_ENTRE_LOTES)
+
+#Turnos terminados mas viejos que el horizonte pasan a turnos_archivo
+def archivar_turnos(hoy: date = None) -> int:
+    total = 0
+    while True:
+        with SessionLocal() as session:
+            movidos = archivar_lote(session, TAMANIO_LOTE_MANTENIMIENTO, hoy)
+            session.commit()
+        total += movidos
+        if movidos < TAMANIO_LOTE_MANTENIMIENTO:
+            return total
+        time.sleep(PAUSA_ENTRE_LOTES)
+
+#Claves de idempotencia vencidas (IDEMPOTENCIA_TTL)
+def purgar_idempotencia() -> int:
+    total = 0
+    while True:
+        with SessionLocal() as session:
+            borradas = purgar_lote(session, TAMANIO_LOTE_MANTENIMIENTO)
+            session.commit()
+        total += borradas
+        if borradas < TAMANIO_LOTE_MANTENIMIENTO:
+            return total
+        time.sleep(PAUSA_ENTRE_LOTES)
+
+# ---------- Planificador -------------
+
+# Una tarea con su intervalo y el resultado de la ultima corrida
+class Tarea:
+
+    def __init__(self, nombre: str, funcion, cada: float):
+        self.nombre = nombre
+        self.funcion = funcion
+        self.cada = cada
+        self.proxima = 0.0
+        self.corridas = 0
+        self.errores = 0
+        self.filas = 0
+        self.ultima_duracion = 0.0
+
+    def correr(self):
+        inicio = time.perf_counter()
+        try:
+            filas = self.funcion()
+        except Exception:
+            self.errores += 1
+            logger.exception("Fallo la tarea de mantenimiento %s", self.nombre)
+            filas = 0
+        self.ultima_duracion = time.perf_counter() - inicio
+        self.corridas += 1
+        self.filas += filas
+        logger.info("Mantenimiento %s: %d filas en %.3f s", self.nombre, filas, self.ultima_duracion)
+
+def _intervalo(nombre: str, por_defecto: float) -> float:
+    return float(os.getenv("MANTENIMIENTO_{}_CADA".format(nombre.upper()), str(por_defecto)))
+
+# Corre las tareas vencidas una por una en un hilo (son sync y usan el engine sync),
+# asi el event loop sigue atendiendo requests mientras tanto
+class Planificador:
+
+    def __init__(self, tareas: list[Tarea]):
+        self.tareas = [tarea for tarea in tareas if tarea.cada > 0]
+        self._task = None
+
+    def iniciar(self):
+        if MANTENIMIENTO_ACTIVO and self.tareas and self._task is None:
+            self._task = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _bucle(self):
+        ahora = time.monotonic()
+        for tarea in self.tareas:
+            tarea.proxima = ahora + DEMORA_INICIAL
+        while True:
+            await asyncio.sleep(max(0.0, min(tarea.proxima for tarea in self.tareas) - time.monotonic()))
+            for tarea in self.tareas:
+                if tarea.proxima <= time.monotonic():
+                    await asyncio.to_thread(tarea.correr)
+                    tarea.proxima = time.monotonic() + tarea.cada
+
+    # Estado de las tareas en formato Prometheus, se agrega a /metrics
+    def exportar(self) -> str:
+        lineas = [
+            "# HELP mantenimiento_corridas_total Corridas de cada tarea de mantenimiento.",
+            "# TYPE mantenimiento_corridas_total counter",
+        ]
+        lineas += ['mantenimiento_corridas_total{{tarea="{}"}} {}'.format(t.nombre, t.corridas) for t in self.tareas]
+        lineas += [
+            "# HELP mantenimiento_errores_total Corridas que terminaron con una excepcion.",
+            "# TYPE mantenimiento_errores_total counter",
+        ]
+        lineas += ['mantenimiento_errores_total{{tarea="{}"}} {}'.format(t.nombre, t.errores) for t in self.tareas]
+        lineas += [
+            "# HELP mantenimiento_filas_total Filas actualizadas por cada tarea.",
+            "# TYPE mantenimiento_filas_total counter",
+        ]
+        lineas += ['mantenimiento_filas_total{{tarea="{}"}} {}'.format(t.nombre, t.filas) for t in self.tareas]
+        lineas += [
+            "# HELP mantenimiento_ultima_duracion_segundos Duracion de la ultima corrida de cada tarea.",
+            "# TYPE mantenimiento_ultima_duracion_segundos gauge",
+        ]
+        lineas += ['mantenimiento_ultima_duracion_segundos{{tarea="{}"}} {}'.format(t.nombre, t.ultima_duracion) for t in self.tareas]
+        return "\n".join(lineas) + "\n"
+
+planificador = Planificador([
+    Tarea("vencer_turnos", vencer_turnos, _intervalo("vencer_turnos", 3600)),
+    Tarea("recalcular_habilitados", recalcular_habilitados, _intervalo("recalcular_habilitados", 3600)),
+    Tarea("archivar_turnos", archivar_turnos, _intervalo("archivar_turnos", 86400)),
+    Tarea("purgar_idempotencia", purgar_idempotencia, _intervalo("purgar_idempotencia", 3600)),
+])
@@ -0,0 +1,143 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from fastapi import Response
+
+# Limites (en segundos) de los buckets del histograma de latencia
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Ruta que se usa cuando el request no matchea ningun endpoint (asi no crece la cantidad de series)
+RUTA_NO_ENCONTRADA = "<no encontrada>"
+
+# Contadores de un hilo. Cada hilo escribe solo en el suyo, asi que registrar un
+# request no toma ningun lock; al exportar se suman todos los shards
+class _Shard:
+
+    def __init__(self):
+        self.requests = defaultdict(int)              # (metodo, ruta, status) -> cantidad
+        self.errores = defaultdict(int)               # (metodo, ruta) -> cantidad
+        self.buckets = defaultdict(lambda: [0] * (len(BUCKETS) + 1))  # (metodo, ruta) -> cuenta por bucket (+Inf al final)
+        self.suma = defaultdict(float)                # (metodo, ruta) -> segundos acumulados
+
+class Metricas:
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: list[_Shard] = []
+        self._lock = threading.Lock() # solo para registrar un shard nuevo
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def registrar(self, metodo: str, ruta: str, status: int, duracion: float):
+        shard = self._shard()
+        clave = (metodo, ruta)
+        shard.requests[(metodo, ruta, status)] += 1
+        if status >= 500:
+            shard.errores[clave] += 1
+        shard.buckets[clave][bisect_left(BUCKETS, duracion)] += 1
+        shard.suma[clave] += duracion
+
+    # Suma los shards. Se copian los dicts antes de recorrerlos porque otro hilo puede estar agregando claves
+    def _sumar(self):
+        requests, errores, suma = defaultdict(int), defaultdict(int), defaultdict(float)
+        buckets = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for clave, cantidad in list(shard.requests.items()):
+                requests[clave] += cantidad
+            for clave, cantidad in list(shard.errores.items()):
+                errores[clave] += cantidad
+            for clave, cuentas in list(shard.buckets.items()):
+                total = buckets[clave]
+                for i, cantidad in enumerate(list(cuentas)):
+                    total[i] += cantidad
+            for clave, segundos in list(shard.suma.items()):
+                suma[clave] += segundos
+        return requests, errores, buckets, suma
+
+    # Texto en formato de exposicion de Prometheus (text/plain; version=0.0.4)
+    def exportar(self) -> str:
+        requests, errores, buckets, suma = self._sumar()
+        lineas = [
+            "# HELP http_requests_total Requests atendidos por metodo, ruta y status.",
+            "# TYPE http_requests_total counter",
+        ]
+        for (metodo, ruta, status), cantidad in sorted(requests.items()):
+            lineas.append('http_requests_total{{method="{}",route="{}",status="{}"}} {}'.format(metodo, _escapar(ruta), status, cantidad))
+
+        lineas += [
+            "# HELP http_request_errors_total Requests que terminaron con status 5xx o con una excepcion.",
+            "# TYPE http_request_errors_total counter",
+        ]
+        for (metodo, ruta), cantidad in sorted(errores.items()):
+            lineas.append('http_request_errors_total{{method="{}",route="{}"}} {}'.format(metodo, _escapar(ruta), cantidad))
+
+        lineas += [
+            "# HELP http_request_duration_seconds Latencia de los requests.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (metodo, ruta), cuentas in sorted(buckets.items()):
+            etiquetas = 'method="{}",route="{}"'.format(metodo, _escapar(ruta))
+            acumulado = 0
+            for limite, cantidad in zip(BUCKETS + (float("inf"),), cuentas):
+                acumulado += cantidad
+                le = "+Inf" if limite == float("inf") else repr(limite)
+                lineas.append('http_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(etiquetas, le, acumulado))
+            lineas.append("http_request_duration_seconds_sum{{{}}} {}".format(etiquetas, suma[(metodo, ruta)]))
+            lineas.append("http_request_duration_seconds_count{{{}}} {}".format(etiquetas, acumulado))
+        return "\n".join(lineas) + "\n"
+
+def _escapar(valor: str) -> str:
+    return valor.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metricas = Metricas()
+
+# Middleware ASGI: mide cada request y lo registra con el template de la ruta
+# (/turno/{id}/cancelar), no con el path real, para no tener una serie por id
+class MetricasMiddleware:
+
+    def __init__(self, app, metricas: Metricas = metricas):
+        self.app = app
+        self.metricas = metricas
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        inicio = time.perf_counter()
+        status = 500
+
+        async def send_con_status(mensaje):
+            nonlocal status
+            if mensaje["type"] == "http.response.start":
+                status = mensaje["status"]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, send_con_status)
+        except Exception:
+            status = 500
+            raise
+        finally:
+            ruta = scope.get("route")
+            self.metricas.registrar(
+                scope["method"],
+                getattr(ruta, "path", RUTA_NO_ENCONTRADA),
+                status,
+                time.perf_counter() - inicio
+            )
+
+# extras: texto en el mismo formato que se agrega al final (metricas de otros modulos)
+def respuesta_metricas(*extras: str) -> Response:
+    return Response(metricas.exportar() + "".join(extras), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -60,6 +60,11 @@ class PersonaOutTurno (BaseModel):
     fecha_nacimiento: date
     edad: int
 
+# Pagina de personas: next_cursor es el id a pasar como cursor para la siguiente pagina
+class PaginaPersonas(BaseModel):
+    items: List[PersonaOut]
+    next_cursor: Optional[int] = None
+
 # Clase para un patch
 class PersonaUpdate(BaseModel):
     nombre: Optional[NombreStr] = None
@@ -68,6 +73,34 @@ class PersonaUpdate(BaseModel):
     telefono: Optional[int] = None
     fecha_nacimiento: Optional[date] = None
 
+# ---------- AGENDAS -------------
+
+# Agenda de un profesional o consultorio. Sin horarios usa los de horarios.json
+class AgendaCreate(BaseModel):
+    nombre: constr(strip_whitespace=True, min_length=2, max_length=60)
+    capacidad: int = 1
+    horarios: Optional[List[time]] = None
+
+    @field_validator("capacidad")
+    @classmethod
+    def capacidad_valida(cls, capacidad: int) -> int:
+        if capacidad < 1:
+            raise ValueError("La capacidad debe ser al menos 1")
+        return capacidad
+
+    @field_validator("horarios")
+    @classmethod
+    def horarios_validos(cls, horarios: Optional[List[time]]) -> Optional[List[time]]:
+        if horarios is not None and not horarios:
+            raise ValueError("La agenda tiene que tener al menos un horario")
+        return horarios
+
+class AgendaOut(BaseModel):
+    id: int
+    nombre: str
+    capacidad: int
+    horarios: List[str]
+
 # ---------- TURNOS -------------
 
 class TurnoCreate(BaseModel):
@@ -75,6 +108,7 @@ class TurnoCreate(BaseModel):
     hora: time
     estado: EstadoEnum=EstadoEnum.PENDIENTE
     id_persona: int  # Solo se envía el ID, no el objeto completo
+    id_agenda: int = 1  # Si no se indica, la agenda general
 
 
 class TurnoConPersonaOut(BaseModel):
@@ -82,14 +116,20 @@ class TurnoConPersonaOut(BaseModel):
     fecha: date
     hora: time
     estado: str
+    id_agenda: int
     persona: PersonaOutTurno 
 
+class PaginaTurnos(BaseModel):
+    items: List[TurnoConPersonaOut]
+    next_cursor: Optional[int] = None
+
 class TurnoOut(BaseModel):
     id: int
     fecha: date
     hora: time
     estado: str
     id_persona: int
+    id_agenda: int
     class Config:
         orm_mode = True
 
@@ -103,6 +143,28 @@ class TurnoUpdate(BaseModel):
 class TurnoEstadoUpdate(BaseModel):
     estado: EstadoEnum
 
+# Maximo de turnos por cambio de estado en lote
+MAX_TURNOS_LOTE = 1000
+
+#para cambiar el estado de muchos turnos a la vez
+class TurnosEstadoLote(BaseModel):
+    ids: List[int]
+    estado: EstadoEnum
+
+    @field_validator("ids")
+    @classmethod
+    def ids_validos(cls, ids: List[int]) -> List[int]:
+        if not ids or len(ids) > MAX_TURNOS_LOTE:
+            raise ValueError("Se debe indicar entre 1 y {} turnos".format(MAX_TURNOS_LOTE))
+        return ids
+
+    @field_validator("estado")
+    @classmethod
+    def estado_destino_valido(cls, estado: EstadoEnum) -> EstadoEnum:
+        if estado not in (EstadoEnum.CONFIRMADO, EstadoEnum.CANCELADO, EstadoEnum.ASISTIDO):
+            raise ValueError("El estado debe ser CONFIRMADO, CANCELADO o ASISTIDO")
+        return estado
+
 #Para mostrar el reporte de personas con turnos por dni 
 class PersonaConTurnosOut(BaseModel):
     id: int
@@ -0,0 +1,87 @@
+import json
+from datetime import date
+
+from fastapi import Response
+from sqlalchemy import select
+
+from database import PersonaDB, TurnoDB
+from utils import calcular_edad
+
+try:
+    import orjson
+except ImportError: # sin orjson se usa el json de la libreria estandar
+    orjson = None
+
+# Un turno con los datos de su persona (TurnoConPersonaOut), en una sola consulta con
+# join y sin armar entidades ORM: cada fila es una tupla con nombre. modelo es TurnoDB
+# o TurnoArchivadoDB, que tienen las mismas columnas
+def select_turnos_con_persona(modelo=TurnoDB):
+    return select(
+        modelo.id, modelo.fecha, modelo.hora, modelo.estado, modelo.id_agenda,
+        PersonaDB.id.label("persona_id"), PersonaDB.nombre, PersonaDB.dni, PersonaDB.fecha_nacimiento
+    ).join(PersonaDB, modelo.id_persona == PersonaDB.id)
+
+# Columnas de TurnoOut
+def select_turnos(modelo=TurnoDB):
+    return select(modelo.id, modelo.fecha, modelo.hora, modelo.estado, modelo.id_persona, modelo.id_agenda)
+
+# Fila de select_turnos_con_persona -> dict con la forma de TurnoConPersonaOut.
+# hoy es la fecha de referencia de la edad, una sola por request
+def fila_a_turno_con_persona(fila, hoy: date) -> dict:
+    return {
+        "id": fila.id,
+        "fecha": fila.fecha,
+        "hora": fila.hora,
+        "estado": fila.estado,
+        "id_agenda": fila.id_agenda,
+        "persona": {
+            "id": fila.persona_id,
+            "nombre": fila.nombre,
+            "dni": fila.dni,
+            "fecha_nacimiento": fila.fecha_nacimiento,
+            "edad": calcular_edad(fila.fecha_nacimiento, hoy)
+        }
+    }
+
+# Lo mismo a partir de las entidades, para los endpoints que ya tienen el turno y la persona cargados
+def turno_con_persona_de(turno: TurnoDB, persona: PersonaDB, hoy: date = None) -> dict:
+    return {
+        "id": turno.id,
+        "fecha": turno.fecha,
+        "hora": turno.hora,
+        "estado": turno.estado,
+        "id_agenda": turno.id_agenda,
+        "persona": {
+            "id": persona.id,
+            "nombre": persona.nombre,
+            "dni": persona.dni,
+            "fecha_nacimiento": persona.fecha_nacimiento,
+            "edad": calcular_edad(persona.fecha_nacimiento, hoy)
+        }
+    }
+
+# Fila de select_turnos -> dict con la forma de TurnoOut
+def fila_a_turno(fila) -> dict:
+    return {
+        "id": fila.id,
+        "fecha": fila.fecha,
+        "hora": fila.hora,
+        "estado": fila.estado,
+        "id_persona": fila.id_persona,
+        "id_agenda": fila.id_agenda
+    }
+
+def _valor_json(valor):
+    if hasattr(valor, "isoformat"): # date y time
+        return valor.isoformat()
+    raise TypeError("No se puede pasar a JSON: {!r}".format(valor))
+
+# Respuesta JSON para los listados grandes: los dicts ya tienen la forma del modelo de
+# respuesta, asi que se serializan directo (con orjson si esta) sin validarlos otra vez
+class RespuestaJSON(Response):
+    media_type = "application/json"
+
+    def render(self, contenido) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(contenido)
+        return json.dumps(contenido, default=_valor_json, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,118 @@
+from datetime import date
+
+from sqlalchemy import delete, event, exists, func, insert, inspect, or_, select, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from database import TurnoArchivadoDB, TurnoDB, TurnosPorDiaDB, engine
+from estadoEnum import EstadoEnum
+
+# Cantidad maxima de fechas por cada IN (...) al recalcular
+TAMANIO_LOTE_FECHAS = 500
+
+# INSERT con ON CONFLICT DO UPDATE de cada dialecto
+_INSERT_UPSERT = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+# Primera clave de los advisory locks de Postgres con que se recuenta un dia a la vez
+# (la segunda es la fecha)
+_LOCK_ROLLUP = 7301
+
+# El resumen turnos_por_dia (fecha, estado, cantidad) se recalcula por dia: cada
+# commit que toca turnos recuenta solo las fechas afectadas, con una consulta
+# agrupada sobre el indice (fecha, estado), dentro de la misma transaccion. Cuenta
+# tambien los turnos archivados, asi archivar no cambia las estadisticas
+
+#Fechas cuyo resumen hay que recalcular antes del commit. Los INSERT/UPDATE hechos
+#con session.execute (altas masivas, updates por lote) tienen que marcarlas a mano
+def marcar_fechas(session: Session, fechas):
+    session.info.setdefault("fechas_rollup", set()).update(f for f in fechas if f is not None)
+
+#Recuenta las fechas con un upsert por lote y borra los estados que quedaron sin turnos.
+#En Postgres dos transacciones pueden recontar el mismo dia a la vez: con el lock por dia
+#(en orden de fecha) la segunda espera al commit de la primera y cuenta sus cambios
+def recalcular_dias(session: Session, fechas):
+    dialecto = session.get_bind().dialect.name
+    fechas = sorted(fechas)
+    for i in range(0, len(fechas), TAMANIO_LOTE_FECHAS):
+        lote = fechas[i:i + TAMANIO_LOTE_FECHAS]
+        if dialecto == "postgresql":
+            for fecha in lote:
+                session.execute(select(func.pg_advisory_xact_lock(_LOCK_ROLLUP, fecha.toordinal())))
+        turnos = union_all(*(
+            select(modelo.fecha, modelo.estado).where(modelo.fecha.in_(lote))
+            for modelo in (TurnoDB, TurnoArchivadoDB)
+        )).subquery()
+        conteo = select(turnos.c.fecha, turnos.c.estado, func.count()).group_by(turnos.c.fecha, turnos.c.estado)
+        if dialecto in _INSERT_UPSERT:
+            session.execute(delete(TurnosPorDiaDB).where(TurnosPorDiaDB.fecha.in_(lote), ~or_(*(
+                exists().where(modelo.fecha == TurnosPorDiaDB.fecha, modelo.estado == TurnosPorDiaDB.estado)
+                for modelo in (TurnoDB, TurnoArchivadoDB)
+            ))))
+            upsert = _INSERT_UPSERT[dialecto](TurnosPorDiaDB).from_select(["fecha", "estado", "cantidad"], conteo)
+            session.execute(upsert.on_conflict_do_update(
+                index_elements=["fecha", "estado"],
+                set_={"cantidad": upsert.excluded.cantidad}
+            ))
+        else:
+            session.execute(delete(TurnosPorDiaDB).where(TurnosPorDiaDB.fecha.in_(lote)))
+            session.execute(insert(TurnosPorDiaDB).from_select(["fecha", "estado", "cantidad"], conteo))
+
+def _despues_de_flush(session, flush_context):
+    fechas = set()
+    for objeto in list(session.new) + list(session.deleted):
+        if isinstance(objeto, TurnoDB):
+            fechas.add(objeto.fecha)
+    for objeto in session.dirty:
+        if isinstance(objeto, TurnoDB):
+            estado = inspect(objeto)
+            if estado.attrs.fecha.history.has_changes() or estado.attrs.estado.history.has_changes():
+                historia = estado.attrs.fecha.history
+                fechas.update(historia.added or ())
+                fechas.update(historia.deleted or ())
+                fechas.update(historia.unchanged or ())
+    if fechas:
+        marcar_fechas(session, fechas)
+
+def _antes_de_commit(session):
+    session.flush()
+    fechas = session.info.pop("fechas_rollup", None)
+    if fechas:
+        recalcular_dias(session, fechas)
+
+def activar_rollup():
+    if not event.contains(Session, "before_commit", _antes_de_commit):
+        event.listen(Session, "after_flush", _despues_de_flush)
+        event.listen(Session, "before_commit", _antes_de_commit)
+
+#Si el resumen esta vacio y hay turnos (base anterior al resumen) se arma entero
+def inicializar_rollup(bind=engine):
+    with Session(bind) as session:
+        if session.query(TurnosPorDiaDB.fecha).first() is None and session.query(TurnoDB.id).first() is not None:
+            fechas = {fecha for (fecha,) in session.query(TurnoDB.fecha).distinct()}
+            fechas.update(fecha for (fecha,) in session.query(TurnoArchivadoDB.fecha).distinct())
+            recalcular_dias(session, fechas)
+            session.commit()
+
+#Cantidad de turnos por estado entre desde y hasta (inclusive), y el detalle por dia si se pide
+def estadisticas_turnos(session: Session, desde: date, hasta: date, por_dia: bool = False) -> dict:
+    filas = session.query(TurnosPorDiaDB.fecha, TurnosPorDiaDB.estado, TurnosPorDiaDB.cantidad).filter(
+        TurnosPorDiaDB.fecha >= desde,
+        TurnosPorDiaDB.fecha <= hasta
+    ).order_by(TurnosPorDiaDB.fecha).all()
+
+    por_estado = {estado.value: 0 for estado in EstadoEnum}
+    dias = {}
+    for fecha, estado, cantidad in filas:
+        por_estado[estado] = por_estado.get(estado, 0) + cantidad
+        if por_dia:
+            dias.setdefault(fecha, {})[estado] = cantidad
+
+    resultado = {
+        "desde": desde,
+        "hasta": hasta,
+        "total": sum(por_estado.values()),
+        "por_estado": por_estado
+    }
+    if por_dia:
+        resultado["por_dia"] = [{"fecha": fecha, "por_estado": cantidades} for fecha, cantidades in dias.items()]
+    return resultado
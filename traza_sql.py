@@ -0,0 +1,82 @@
+import logging
+import os
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+# Modo traza: se activa con la variable de entorno TRAZA_SQL=1. Apagado no registra
+# ningun listener, asi que no agrega costo a las consultas
+TRAZA_SQL_ACTIVA = os.getenv("TRAZA_SQL", "0") == "1"
+
+# Veces que tiene que repetirse la misma sentencia en un request para marcarla como posible N+1
+UMBRAL_N_MAS_1 = int(os.getenv("TRAZA_SQL_UMBRAL", "3"))
+
+logger = logging.getLogger("traza_sql")
+
+# Consultas de un request: cantidad, tiempo total y cuantas veces aparece cada sentencia
+class Traza:
+
+    def __init__(self):
+        self.consultas = 0
+        self.segundos = 0.0
+        self.sentencias = Counter()
+
+    def repetidas(self) -> list[tuple[str, int]]:
+        return [(sql, veces) for sql, veces in self.sentencias.most_common() if veces >= UMBRAL_N_MAS_1]
+
+_traza_actual: ContextVar = ContextVar("traza_sql", default=None)
+
+def _antes(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("traza_inicio", []).append(time.perf_counter())
+
+def _despues(conn, cursor, statement, parameters, context, executemany):
+    inicio = conn.info["traza_inicio"].pop()
+    traza = _traza_actual.get()
+    if traza is not None:
+        traza.consultas += 1
+        traza.segundos += time.perf_counter() - inicio
+        traza.sentencias[statement] += 1
+
+# Engancha los eventos de los engines (para el async se usa su sync_engine)
+def activar_traza_sql(*engines):
+    for engine in engines:
+        engine = getattr(engine, "sync_engine", engine)
+        if not event.contains(engine, "before_cursor_execute", _antes):
+            event.listen(engine, "before_cursor_execute", _antes)
+            event.listen(engine, "after_cursor_execute", _despues)
+
+# Middleware ASGI: abre una traza por request, agrega los totales en los headers
+# X-SQL-Queries, X-SQL-Time-ms y X-SQL-Repetidas y lo deja en el log
+class TrazaSQLMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traza = Traza()
+        token = _traza_actual.set(traza)
+
+        async def send_con_headers(mensaje):
+            if mensaje["type"] == "http.response.start":
+                repetidas = traza.repetidas()
+                mensaje["headers"] = list(mensaje.get("headers", [])) + [
+                    (b"x-sql-queries", str(traza.consultas).encode()),
+                    (b"x-sql-time-ms", "{:.3f}".format(traza.segundos * 1000).encode()),
+                    (b"x-sql-repetidas", str(len(repetidas)).encode()),
+                ]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, send_con_headers)
+        finally:
+            _traza_actual.reset(token)
+            ruta = getattr(scope.get("route"), "path", scope["path"])
+            logger.debug("%s %s: %d consultas, %.3f ms", scope["method"], ruta, traza.consultas, traza.segundos * 1000)
+            for sql, veces in traza.repetidas():
+                logger.warning("Posible N+1 en %s %s: sentencia repetida %d veces: %s", scope["method"], ruta, veces, " ".join(sql.split()))
@@ -1,11 +1,32 @@
-from datetime import date, timedelta, datetime
-import json
+from datetime import date, time, timedelta, datetime
+from functools import lru_cache
 from estadoEnum import EstadoEnum
-from models import PersonaOut, TurnoOut
-from database import PersonaDB, Session, TurnoDB 
+from models import AgendaOut, PersonaOut, TurnoOut
+from database import AgendaDB, PersonaDB, Session, TurnoArchivadoDB, TurnoDB 
+from horarios import config_horarios
+from sqlalchemy import case, func, update
+from rollup import marcar_fechas
+from sqlalchemy.exc import IntegrityError
 
-def calcular_edad(fecha_nacimiento: date) -> int:
-    hoy = date.today()
+#Tamaño de pagina de los listados (GET /personas, GET /turnos)
+PAGINA_DEFAULT = 100
+PAGINA_MAX = 1000
+
+#Una persona con MAX_CANCELADOS turnos cancelados en los ultimos VENTANA_CANCELADOS dias queda inhabilitada
+VENTANA_CANCELADOS = 180
+MAX_CANCELADOS = 5
+
+#Cantidad maxima de ids por cada IN (...) en las consultas por lotes
+TAMANIO_LOTE_IN = 500
+
+#Maxima cantidad de dias que se puede consultar de una vez en /turnos-disponibles
+MAX_DIAS_DISPONIBILIDAD = 90
+#Maxima cantidad de agendas por consulta de /turnos-disponibles
+MAX_AGENDAS_DISPONIBILIDAD = 50
+
+#hoy se puede pasar para calcular muchas edades contra la misma fecha de referencia
+def calcular_edad(fecha_nacimiento: date, hoy: date = None) -> int:
+    hoy = hoy or date.today()
     edad = hoy.year - fecha_nacimiento.year
 
     #Si la persona no cumplió años todavía se le resta 1
@@ -31,43 +52,266 @@ def to_turno_out(t: TurnoDB) -> TurnoOut:
         fecha=t.fecha,
         hora=t.hora,
         estado=t.estado,
-        id_persona=t.id_persona
-
+        id_persona=t.id_persona,
+        id_agenda=t.id_agenda
     )
 
-# verifico si la persona esta habilitada
-def persona_habilitada(persona: PersonaDB, session: Session):
-    limite_fecha = datetime.now() - timedelta(days=180)
+#Paginacion keyset: la query tiene que venir ordenada por id y pedir limit + 1 filas,
+#la de mas indica que hay otra pagina; el cursor siguiente es el id de la ultima fila devuelta
+def paginar(filas: list, limit: int, id_de=lambda fila: fila.id):
+    if len(filas) <= limit:
+        return filas, None
+    filas = filas[:limit]
+    return filas, id_de(filas[-1])
+
+#Primer dia en que un cancelado con esa fecha ya no cuenta (queda fuera de los ultimos 180 dias)
+def vencimiento_cancelado(fecha: date) -> date:
+    return fecha + timedelta(days=VENTANA_CANCELADOS + 1)
 
-    cancelados_persona = session.query(TurnoDB).filter(
+#Recalcula desde los turnos el contador de cancelados recientes de la persona.
+#Solo se usa cuando vence algun cancelado o cuando un turno se edita o borra
+def recalcular_cancelados(persona: PersonaDB, session: Session, hoy: date = None):
+    hoy = hoy or date.today()
+    cantidad, fecha_mas_vieja = session.query(func.count(TurnoDB.id), func.min(TurnoDB.fecha)).filter(
         TurnoDB.id_persona == persona.id,
         TurnoDB.estado == EstadoEnum.CANCELADO,
-        TurnoDB.fecha >= limite_fecha
-    ).count()
+        TurnoDB.fecha >= hoy - timedelta(days=VENTANA_CANCELADOS)
+    ).one()
+
+    persona.cancelados_recientes = cantidad
+    persona.cancelados_vencen = vencimiento_cancelado(fecha_mas_vieja) if fecha_mas_vieja else None
+    persona.habilitado = cantidad < MAX_CANCELADOS
+
+#Lo mismo que recalcular_cancelados pero para muchas personas a la vez: una consulta
+#agrupada y un UPDATE por lote de ids, sin cargar las personas en la sesion
+def recalcular_cancelados_personas(ids_personas, session: Session, hoy: date = None):
+    hoy = hoy or date.today()
+    ids = list(ids_personas)
+    for i in range(0, len(ids), TAMANIO_LOTE_IN):
+        lote = ids[i:i + TAMANIO_LOTE_IN]
+        cancelados = {
+            id_persona: (cantidad, fecha_mas_vieja)
+            for id_persona, cantidad, fecha_mas_vieja in session.query(
+                TurnoDB.id_persona, func.count(TurnoDB.id), func.min(TurnoDB.fecha)
+            ).filter(
+                TurnoDB.id_persona.in_(lote),
+                TurnoDB.estado == EstadoEnum.CANCELADO,
+                TurnoDB.fecha >= hoy - timedelta(days=VENTANA_CANCELADOS)
+            ).group_by(TurnoDB.id_persona)
+        }
+        valores = []
+        for id_persona in lote:
+            cantidad, fecha_mas_vieja = cancelados.get(id_persona, (0, None))
+            valores.append({
+                "id": id_persona,
+                "cancelados_recientes": cantidad,
+                "cancelados_vencen": vencimiento_cancelado(fecha_mas_vieja) if fecha_mas_vieja else None,
+                "habilitado": cantidad < MAX_CANCELADOS
+            })
+        if valores:
+            session.execute(update(PersonaDB), valores)
+
+#Si algun cancelado ya salio de la ventana, se recalcula; si no, no hay nada que hacer
+def expirar_cancelados(persona: PersonaDB, session: Session, hoy: date = None):
+    hoy = hoy or date.today()
+    if persona.cancelados_vencen is not None and persona.cancelados_vencen <= hoy:
+        recalcular_cancelados(persona, session, hoy)
 
-    persona.habilitado = cancelados_persona < 5
-    session.commit()
-    session.refresh(persona)
+#Suma un cancelado al contador de la persona. El UPDATE se arma con los valores
+#de la base (x = x + 1) para que dos cancelaciones simultaneas no se pisen.
+#Si algun cancelado ya vencio se recuenta todo desde los turnos (el turno ya esta
+#CANCELADO, asi que el recuento lo incluye) y no se suma nada mas.
+#No hace commit, queda dentro de la transaccion del que llama
+def registrar_cancelacion(persona: PersonaDB, turno: TurnoDB, session: Session):
+    hoy = date.today()
+    if persona.cancelados_vencen is not None and persona.cancelados_vencen <= hoy:
+        session.flush()
+        recalcular_cancelados(persona, session, hoy)
+        session.flush()
+        return
+    if turno.fecha < hoy - timedelta(days=VENTANA_CANCELADOS):
+        return
+
+    vence = vencimiento_cancelado(turno.fecha)
+    persona.cancelados_recientes = PersonaDB.cancelados_recientes + 1
+    persona.habilitado = PersonaDB.cancelados_recientes + 1 < MAX_CANCELADOS
+    persona.cancelados_vencen = case(
+        (PersonaDB.cancelados_vencen.is_(None), vence),
+        (PersonaDB.cancelados_vencen > vence, vence),
+        else_=PersonaDB.cancelados_vencen
+    )
+    session.flush()
+
+# verifico si la persona esta habilitada: lectura del contador, vence los cancelados viejos si hace falta
+def persona_habilitada(persona: PersonaDB, session: Session):
+    expirar_cancelados(persona, session)
     return persona.habilitado
 
-#Leo los horarios del json
-def leer_horarios ():
-    with open ("horarios.json", "r", encoding= "utf-8") as archivo:
-        horarios = json.load (archivo)
-        horarios_posibles = horarios ["horarios"]
-        return horarios_posibles
-    
-#convierto de string a time
-def to_time (hora: str):
-    hora_time = datetime.strptime(hora, "%H:%M").time()
-    return hora_time
+#Los horarios propios de una agenda se guardan como "HH:MM,HH:MM,..."; se parsean una vez por texto
+@lru_cache(maxsize=256)
+def _parsear_horarios(texto: str) -> tuple[time, ...]:
+    return tuple(sorted(datetime.strptime(h.strip(), "%H:%M").time() for h in texto.split(",")))
+
+def horarios_a_texto(horarios) -> str:
+    return ",".join(sorted({horario.strftime("%H:%M") for horario in horarios}))
+
+#Horarios posibles de la agenda ordenados (los de horarios.json si no tiene propios)
+def horarios_de_agenda(agenda: AgendaDB) -> tuple[time, ...]:
+    if agenda.horarios:
+        return _parsear_horarios(agenda.horarios)
+    return config_horarios.horarios()
+
+def horario_valido(agenda: AgendaDB, hora: time) -> bool:
+    if agenda.horarios:
+        return hora in _parsear_horarios(agenda.horarios)
+    return config_horarios.es_valido(hora)
+
+def to_agenda_out(agenda: AgendaDB) -> AgendaOut:
+    return AgendaOut(
+        id=agenda.id,
+        nombre=agenda.nombre,
+        capacidad=agenda.capacidad,
+        horarios=[horario.strftime("%H:%M") for horario in horarios_de_agenda(agenda)]
+    )
+
+#Bitmap de ocupacion por agenda y dia: el bit i prendido es el horario i de la agenda
+#completo (tantos turnos activos como capacidad). Se resuelven todas las agendas y todo
+#el rango con una sola consulta agrupada por (agenda, fecha, hora)
+def ocupacion_por_dia(desde: date, hasta: date, agendas: list[AgendaDB], session: Session) -> dict[tuple[int, date], int]:
+    posiciones = {agenda.id: {horario: i for i, horario in enumerate(horarios_de_agenda(agenda))} for agenda in agendas}
+    capacidades = {agenda.id: agenda.capacidad for agenda in agendas}
 
-#valido que el estado no sea CANCELADO o ASISTIDO
+    ocupados = session.query(TurnoDB.id_agenda, TurnoDB.fecha, TurnoDB.hora, func.count(TurnoDB.id)).filter(
+        TurnoDB.id_agenda.in_(list(capacidades)),
+        TurnoDB.fecha >= desde,
+        TurnoDB.fecha <= hasta,
+        TurnoDB.estado != EstadoEnum.CANCELADO
+    ).group_by(TurnoDB.id_agenda, TurnoDB.fecha, TurnoDB.hora).all()
+
+    bitmap: dict[tuple[int, date], int] = {}
+    for id_agenda, fecha, hora, cantidad in ocupados:
+        if cantidad < capacidades[id_agenda]:
+            continue
+        i = posiciones[id_agenda].get(hora)
+        if i is not None: #un turno fuera de la grilla no ocupa ningun horario
+            bitmap[(id_agenda, fecha)] = bitmap.get((id_agenda, fecha), 0) | (1 << i)
+    return bitmap
+
+#Horarios libres ("HH:MM") de cada agenda y cada dia entre desde y hasta, inclusive
+def turnos_disponibles_por_dia(desde: date, hasta: date, agendas: list[AgendaDB], session: Session) -> dict[int, dict[date, list[str]]]:
+    bitmap = ocupacion_por_dia(desde, hasta, agendas, session)
+
+    disponibles = {}
+    for agenda in agendas:
+        horarios = [horario.strftime("%H:%M") for horario in horarios_de_agenda(agenda)]
+        disponibles[agenda.id] = {}
+        for n in range((hasta - desde).days + 1):
+            fecha = desde + timedelta(days=n)
+            ocupado = bitmap.get((agenda.id, fecha), 0)
+            disponibles[agenda.id][fecha] = [h for i, h in enumerate(horarios) if not ocupado >> i & 1]
+    return disponibles
+
+#Primer cupo libre (1..capacidad) del horario de la agenda, o None si esta completo.
+#excluir_id es el turno que se esta modificando, que no se cuenta a si mismo
+def cupo_libre(agenda: AgendaDB, fecha: date, hora: time, session: Session, excluir_id: int = None):
+    query = session.query(TurnoDB.cupo).filter(
+        TurnoDB.id_agenda == agenda.id,
+        TurnoDB.fecha == fecha,
+        TurnoDB.hora == hora,
+        TurnoDB.estado != EstadoEnum.CANCELADO
+    )
+    if excluir_id is not None:
+        query = query.filter(TurnoDB.id != excluir_id)
+    tomados = {cupo for (cupo,) in query}
+    if len(tomados) >= agenda.capacidad:
+        return None
+    return next(cupo for cupo in range(1, agenda.capacidad + 1) if cupo not in tomados)
+
+#El indice unico uq_turnos_agenda_cupo_activo es el que garantiza un solo turno activo por
+#cupo: si dos requests pasan la verificacion a la vez, el segundo INSERT/UPDATE falla aca
+def es_lugar_duplicado(error: IntegrityError) -> bool:
+    mensaje = str(error.orig)
+    return "uq_turnos_agenda_cupo_activo" in mensaje or "turnos.id_agenda, turnos.fecha, turnos.hora, turnos.cupo" in mensaje
+
+#Guarda el turno (nuevo o modificado) con `valores` en el primer cupo libre del horario.
+#Si otro request toma ese cupo entre la consulta y el INSERT/UPDATE, el indice unico lo
+#rechaza dentro de un savepoint y se prueba con el siguiente cupo libre. Devuelve False
+#solo si el horario esta lleno
+def ocupar_cupo(turno: TurnoDB, valores: dict, agenda: AgendaDB, session: Session) -> bool:
+    for _ in range(agenda.capacidad + 1):
+        cupo = cupo_libre(agenda, valores["fecha"], valores["hora"], session, excluir_id=turno.id)
+        if cupo is None:
+            return False
+        try:
+            with session.begin_nested():
+                for campo, valor in dict(valores, cupo=cupo).items():
+                    setattr(turno, campo, valor)
+                session.add(turno)
+        except IntegrityError as e:
+            if not es_lugar_duplicado(e):
+                raise
+        else:
+            return True
+    return False
+
+#valido que el estado no sea CANCELADO, ASISTIDO o VENCIDO
 def validar_estado (turno: TurnoDB):
-    if turno.estado in [EstadoEnum.CANCELADO, EstadoEnum.ASISTIDO]:
-        raise Exception("No se puede modificar un turno que ya fue CANCELADO o ASISTIDO")
+    if turno.estado in [EstadoEnum.CANCELADO, EstadoEnum.ASISTIDO, EstadoEnum.VENCIDO]:
+        raise Exception("No se puede modificar un turno que ya fue CANCELADO, ASISTIDO o VENCIDO")
     return True
 
+#Pasa muchos turnos a `estado` en la transaccion del que llama, con las reglas de
+#validar_estado, y devuelve el resultado de cada id. El UPDATE vuelve a filtrar por
+#estado, asi un turno que otro request cerro en el medio no se pisa. Si se cancela,
+#el contador de cada persona afectada se recalcula una sola vez
+def cambiar_estado_turnos(ids: list[int], estado: EstadoEnum, session: Session) -> list[dict]:
+    ids = list(dict.fromkeys(ids))
+    errores, validos = {}, []
+    for i in range(0, len(ids), TAMANIO_LOTE_IN):
+        lote = ids[i:i + TAMANIO_LOTE_IN]
+        encontrados = set()
+        for turno in session.query(TurnoDB.id, TurnoDB.estado).filter(TurnoDB.id.in_(lote)):
+            encontrados.add(turno.id)
+            try:
+                validar_estado(turno)
+                validos.append(turno.id)
+            except Exception as e:
+                errores[turno.id] = str(e)
+        #los archivados son turnos terminados: mismo error que si estuvieran en turnos
+        faltantes = [id for id in lote if id not in encontrados]
+        for turno in session.query(TurnoArchivadoDB.id, TurnoArchivadoDB.estado).filter(TurnoArchivadoDB.id.in_(faltantes)):
+            try:
+                validar_estado(turno)
+            except Exception as e:
+                errores[turno.id] = str(e)
+
+    actualizados, fechas, personas = set(), set(), set()
+    for i in range(0, len(validos), TAMANIO_LOTE_IN):
+        for id, fecha, id_persona in session.execute(
+            update(TurnoDB)
+            .where(TurnoDB.id.in_(validos[i:i + TAMANIO_LOTE_IN]))
+            .where(TurnoDB.estado.in_([EstadoEnum.PENDIENTE, EstadoEnum.CONFIRMADO]))
+            .values(estado=estado)
+            .returning(TurnoDB.id, TurnoDB.fecha, TurnoDB.id_persona),
+            execution_options={"synchronize_session": False}
+        ):
+            actualizados.add(id)
+            fechas.add(fecha)
+            personas.add(id_persona)
+    marcar_fechas(session, fechas)
+    if estado == EstadoEnum.CANCELADO and personas:
+        recalcular_cancelados_personas(personas, session)
+
+    resultados = []
+    for id in ids:
+        if id in actualizados:
+            resultados.append({"id": id, "ok": True, "estado": estado})
+        elif id in validos:
+            resultados.append({"id": id, "ok": False, "error": "El turno cambio de estado mientras se actualizaba"})
+        else:
+            resultados.append({"id": id, "ok": False, "error": errores.get(id, "Turno no encontrado")})
+    return resultados
+
 #valido que el estado no sea ASISTIDO (para eliminar)
 def validar_estado_solo_asistido (turno: TurnoDB):
    if turno.estado == EstadoEnum.ASISTIDO:
@@ -81,65 +325,61 @@ def obtener_persona_por_dni (dni: str, session: Session):
     
     return persona
 
-def obtener_turnos_por_persona (id_persona: int, session: Session):
-    turnos = session.query(TurnoDB).filter(TurnoDB.id_persona == id_persona).all()
-    if not turnos:
-        raise Exception ("La persona no tiene turnos asignados")
-    return turnos
-
 def calcular_limite_fecha(dias: int):
     limite_fecha = datetime.now() - timedelta(days=dias)
     return limite_fecha
 
 def obtener_personas_con_turnos_cancelados(session: Session, limite_fecha: datetime, min_cancelados: int = 5):
-    personas_bd = session.query(PersonaDB).all()
-
-    if not personas_bd:
+    if not session.query(PersonaDB.id).first():
         raise Exception("No hay personas en la base de datos")
-    
-    personas_con_cancelados = []
 
-    for persona in personas_bd:
-        turnos_cancelados = session.query(TurnoDB).filter(
-            TurnoDB.id_persona == persona.id,
-            TurnoDB.estado == EstadoEnum.CANCELADO,
-            TurnoDB.fecha >= limite_fecha
-        ).all()
-
-        if len(turnos_cancelados) >= min_cancelados:
-            personas_con_cancelados.append({
-                "persona": {
-                    "id": persona.id,
-                    "nombre": persona.nombre,
-                    "email": persona.email,
-                    "dni": str(persona.dni),
-                    "telefono": persona.telefono,
-                    "fecha_nacimiento": persona.fecha_nacimiento,
-                    "edad": calcular_edad(persona.fecha_nacimiento),
-                    "habilitado": persona.habilitado
-                },
-                "cantidad_cancelados": len(turnos_cancelados),
-                "turnos_cancelados": [
-                    {
-                        "id": turno.id,
-                        "fecha": turno.fecha,
-                        "hora": turno.hora,
-                        "estado": turno.estado
-                    }
-                    for turno in turnos_cancelados
-                ]
-            })
-    return personas_con_cancelados
-def obtener_turnos_entre_fechas(fechaDesde: date, fechaHasta: date, session: Session):
-    
-    turnos_confirmados = session.query(TurnoDB).filter(
-        (TurnoDB.fecha >= fechaDesde) & (TurnoDB.fecha <= fechaHasta)
-    ).all()
+    filtro_cancelados = (TurnoDB.estado == EstadoEnum.CANCELADO) & (TurnoDB.fecha >= limite_fecha)
+    cantidad = func.count(TurnoDB.id)
+
+    #una sola consulta agrupada por persona con los que llegan al minimo
+    if min_cancelados > 0:
+        query = session.query(PersonaDB, cantidad).join(TurnoDB, TurnoDB.id_persona == PersonaDB.id).filter(filtro_cancelados)
+    else:
+        #con minimo 0 entran tambien las personas sin cancelados
+        query = session.query(PersonaDB, cantidad).outerjoin(TurnoDB, (TurnoDB.id_persona == PersonaDB.id) & filtro_cancelados)
+    personas_cantidad = query.group_by(PersonaDB.id).having(cantidad >= min_cancelados).order_by(PersonaDB.id).all()
 
-    if not turnos_confirmados:
-        raise Exception("No hay turnos registrados entre esas fechas.")
+    #detalle de los turnos cancelados, solo de las personas que califican, en lotes
+    turnos_por_persona = {persona.id: [] for persona, _ in personas_cantidad}
+    ids = list(turnos_por_persona)
+    for i in range(0, len(ids), TAMANIO_LOTE_IN):
+        turnos_cancelados = session.query(TurnoDB).filter(
+            TurnoDB.id_persona.in_(ids[i:i + TAMANIO_LOTE_IN]),
+            filtro_cancelados
+        ).order_by(TurnoDB.id).all()
+        for turno in turnos_cancelados:
+            turnos_por_persona[turno.id_persona].append(turno)
 
-    return turnos_confirmados
+    personas_con_cancelados = []
+    for persona, cantidad_cancelados in personas_cantidad:
+        personas_con_cancelados.append({
+            "persona": {
+                "id": persona.id,
+                "nombre": persona.nombre,
+                "email": persona.email,
+                "dni": str(persona.dni),
+                "telefono": persona.telefono,
+                "fecha_nacimiento": persona.fecha_nacimiento,
+                "edad": calcular_edad(persona.fecha_nacimiento),
+                "habilitado": persona.habilitado
+            },
+            "cantidad_cancelados": cantidad_cancelados,
+            "turnos_cancelados": [
+                {
+                    "id": turno.id,
+                    "fecha": turno.fecha,
+                    "hora": turno.hora,
+                    "estado": turno.estado
+                }
+                for turno in turnos_por_persona[persona.id]
+            ]
+        })
+    return personas_con_cancelados
 
 def obtener_personas_por_estado(estado: bool, session: Session):
     personas_estado = session.query(PersonaDB).filter(PersonaDB.habilitado == estado).all()